@@ -0,0 +1,76 @@
+"""
+Per-eval latency of the NDE density evaluations: for the MAF, the training graph, the inference-mode
+graph (cached masked weights, fused matmuls) and the exported NumPy evaluator; for the MDN, the
+log-domain density against the previous exp/log formulation and against a triangular mat-vec
+in place of the dense Sigma (y - mu) matmul, and the NumPy evaluator.
+
+    python benchmarks/nde_inference.py
+"""
+
+import timeit
+import numpy as np
+import tensorflow as tf
+import pydelfi.ndes as ndes
+
+def benchmark(name, f, number):
+
+    t = min(timeit.repeat(f, number=number, repeat=5))/number
+    print('{:<40s} {:10.1f} us'.format(name, t*1e6))
+
+def benchmark_maf(n_parameters=5, n_data=5, n_hiddens=[50,50], n_mades=5, batch_sizes=[1, 100, 10000]):
+
+    tf.reset_default_graph()
+    maf = ndes.ConditionalMaskedAutoregressiveFlow(n_parameters=n_parameters, n_data=n_data, n_hiddens=n_hiddens,
+                                                    act_fun=tf.tanh, n_mades=n_mades)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    maf.refresh_inference_weights(sess)
+    evaluator = maf.export(sess)
+
+    print('MAF: {:d} mades, n_parameters = {:d}, n_data = {:d}, n_hiddens = {}'.format(n_mades, n_parameters, n_data, n_hiddens))
+    for n in batch_sizes:
+        x = np.random.normal(0, 1, (n, n_parameters)).astype(np.float32)
+        y = np.random.normal(0, 1, (n, n_data)).astype(np.float32)
+        number = max(10, 10000//n)
+        assert np.allclose(sess.run(maf.L, {maf.parameters: x, maf.data: y}), maf.eval((x, y), sess, inference_mode=True), atol=1e-4)
+        benchmark('batch {:d}: training graph'.format(n), lambda: sess.run(maf.L, {maf.parameters: x, maf.data: y}), number)
+        benchmark('batch {:d}: inference graph'.format(n), lambda: maf.eval((x, y), sess, inference_mode=True), number)
+        benchmark('batch {:d}: numpy evaluator'.format(n), lambda: evaluator.eval((x, y)), number)
+    sess.close()
+
+def benchmark_mdn(n_parameters=5, n_data=[5, 20, 50], n_components=10, n_hidden=[50,50], batch_sizes=[1, 1000]):
+
+    for n in n_data:
+        tf.reset_default_graph()
+        mdn = ndes.MixtureDensityNetwork(n_parameters=n_parameters, n_data=n, n_components=n_components, n_hidden=n_hidden,
+                                         activations=[tf.tanh, tf.tanh])
+
+        # Previous formulation: exp/log with a product determinant and a dense einsum
+        L_exp = tf.log(tf.reduce_sum(tf.exp(-0.5*tf.reduce_sum(tf.square(tf.einsum("ijlk,ijk->ijl", mdn.Sigma, tf.subtract(tf.expand_dims(mdn.data, 1), mdn.mu))), 2) + \
+                                            tf.log(mdn.alpha) + tf.log(mdn.det) - n*np.log(2. * np.pi) / 2.), 1, keepdims=True) + 1e-37)
+        # The log-domain density with a lower-triangular mat-vec for Sigma (y - mu)
+        r = tf.linalg.LinearOperatorLowerTriangular(mdn.Sigma).matvec(tf.subtract(tf.expand_dims(mdn.data, 1), mdn.mu))
+        L_tril = tf.reduce_logsumexp(-0.5*tf.reduce_sum(tf.square(r), 2) + mdn.log_alpha + mdn.logdet - n*np.log(2. * np.pi) / 2., 1, keepdims=True)
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        evaluator = mdn.export(sess)
+
+        print('MDN: n_components = {:d}, n_parameters = {:d}, n_data = {:d}'.format(n_components, n_parameters, n))
+        for b in batch_sizes:
+            x = np.random.normal(0, 1, (b, n_parameters)).astype(np.float32)
+            y = np.random.normal(0, 0.1, (b, n)).astype(np.float32)
+            number = max(10, 1000//b)
+            L, L_ref = sess.run([mdn.L, L_exp], {mdn.parameters: x, mdn.data: y})
+            assert np.allclose(sess.run(L_tril, {mdn.parameters: x, mdn.data: y}), L, rtol=1e-4, atol=1e-3)
+            resolved = L_ref > np.log(1e-37) + 1 # otherwise the exp/log form has underflowed onto its 1e-37 floor
+            print('batch {:d}: max |L - L_exp| = {:.2e} ({:d}/{:d} L_exp underflowed)'.format(b, np.max(np.abs(L - L_ref)[resolved]) if resolved.any() else 0., int(np.sum(~resolved)), b))
+            benchmark('batch {:d}: exp/log graph'.format(b), lambda: sess.run(L_exp, {mdn.parameters: x, mdn.data: y}), number)
+            benchmark('batch {:d}: log-domain graph'.format(b), lambda: mdn.eval((x, y), sess), number)
+            benchmark('batch {:d}: triangular mat-vec graph'.format(b), lambda: sess.run(L_tril, {mdn.parameters: x, mdn.data: y}), number)
+            benchmark('batch {:d}: numpy evaluator'.format(b), lambda: evaluator.eval((x, y)), number)
+        sess.close()
+
+if __name__ == '__main__':
+
+    benchmark_maf()
+    benchmark_mdn()
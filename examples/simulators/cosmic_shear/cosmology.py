@@ -732,7 +732,7 @@ class cosmology(object):
         g = self.G(a)
         t = self.T(k, **kwargs)
 
-        pknorm = self.sigma8**2/self.sigmasqr(8.0, **kwargs)
+        pknorm = self._pk_normalization(**kwargs)
 
         if k.ndim == 1:
             pk = outer(self.pk_prim(k) * pow(t, 2), pow(g, 2))
@@ -744,41 +744,55 @@ class cosmology(object):
 
         return pk.squeeze()
 
+    def _pk_normalization(self, **kwargs):
+        r""" sigma8 normalisation of the linear power spectrum, cached for
+        the default transfer function until the cosmology is updated"""
+        if kwargs:
+            return self.sigma8**2/self.sigmasqr(8.0, **kwargs)
+        if self._pknorm is None:
+            self._pknorm = self.sigma8**2/self.sigmasqr(8.0)
+        return self._pknorm
+
     def _smith_parameters(self, a,  **kwargs):
         r""" Computes the non linear scale, effective spectral index
-        and spectral curvature"""
-        a = atleast_1d(a)
-        R_nl = zeros_like(a)
-        n = zeros_like(a)
-        C = zeros_like(a)
-
-        ksamp = logspace(log10(self._kmin), log10(self._kmax), 1024)
-        pklog = interp1d(log(ksamp), ksamp**3 *
-                         self.pk_lin(ksamp, **kwargs) / (2.0*pi**2))
-        g = self.G(a)
-
-        def int_sigma(logk, r, _g):
-            y = exp(logk)*r
-            return pklog(logk) * _g**2 * exp(-y**2)
+        and spectral curvature
 
-        def int_neff(logk, r, _g):
-            y = exp(logk)*r
-            return pklog(logk) * _g**2 * y**2 * exp(-y**2)
-
-        def int_C(logk, r, _g):
-            y = exp(logk)*r
-            return pklog(logk) * _g**2 * (y**2 - y**4) * exp(-y**2)
-
-        for i in range(R_nl.size):
-            sigm = lambda r: romberg(int_sigma, log(self._kmin), log(self._kmax),
-                                     args=(exp(r), g[i]), rtol=1e-4, vec_func=True, divmax=100) - 1
-            R_nl[i] = exp(brentq(sigm, -5, 1.5, rtol=1e-4))
-
-            n[i] = 2.0 * romberg(int_neff, log(self._kmin), log(self._kmax),
-                                    args=(R_nl[i], g[i]), rtol=1e-4,  vec_func=True, divmax=100) - 3
+        All scale factors are handled at once: since sigma^2(R, a) =
+        G(a)^2 sigma^2(R, 1), the Gaussian filtered variance of the linear
+        spectrum today is tabulated once on a shared grid and inverted for
+        every scale factor, then polished with Newton steps.
+        """
+        a = atleast_1d(a)
+        g2 = self.G(a)**2
+
+        # Dimensionless linear power today, sampled uniformly in log k
+        logk = linspace(log(self._kmin), log(self._kmax), 2**10 + 1)
+        dlogk = logk[1] - logk[0]
+        ksamp = exp(logk)
+        d2lin = ksamp**3 * self.pk_lin(ksamp, **kwargs) / (2.0*pi**2)
+
+        # Filtered variance today, decreasing with R
+        logr = linspace(-5, 1.5, 33)
+        y2 = outer(exp(logr), ksamp)**2
+        logsig2 = log(romb(d2lin * exp(-y2), dlogk, axis=-1))
+        if any(-log(g2) < logsig2[-1]) or any(-log(g2) > logsig2[0]):
+            raise ValueError("non linear scale outside of the tabulated range")
+
+        # Solve G(a)^2 sigma^2(R_nl) = 1, using d ln sigma^2 / d ln R = -(3 + n)
+        logr_nl = interp(-log(g2), logsig2[::-1], logr[::-1])
+        for i in range(3):
+            y2 = outer(exp(logr_nl), ksamp)**2
+            sig2 = romb(d2lin * exp(-y2), dlogk, axis=-1)
+            dsig2 = -2.0 * romb(d2lin * y2 * exp(-y2), dlogk, axis=-1)
+            logr_nl = logr_nl - log(g2 * sig2) * sig2 / dsig2
+        R_nl = exp(logr_nl)
+
+        # Effective spectral index and curvature at the non linear scale
+        y2 = outer(R_nl, ksamp)**2
+        integrand = d2lin * y2 * exp(-y2)
+        n = 2.0 * g2 * romb(integrand, dlogk, axis=-1) - 3
+        C = (3 + n)**2 + 4 * g2 * romb(integrand * (1 - y2), dlogk, axis=-1)
 
-            C[i] = (3 + n[i])**2 + 4 * romberg(int_C, log(self._kmin), log(self._kmax),
-                                                  args=(R_nl[i], g[i]), rtol=1e-4,  vec_func=True, divmax=100)
         k_nl = 1.0/R_nl
         return k_nl, n, C
 
@@ -887,7 +901,7 @@ class cosmology(object):
         g = self.G(a)
         t = self.T(k, **kwargs)
 
-        pknorm = self.sigma8**2/self.sigmasqr(8.0, **kwargs)
+        pknorm = self._pk_normalization(**kwargs)
 
         pk = multiply(self.pk_prim(k) * pow(t, 2), pow(g, 2))
 
@@ -1,11 +1,31 @@
 import numpy as np
+import os
+import json
+import zlib
+import hashlib
+from collections import OrderedDict
+
+cmat_names = ['v0', 'va', 'vb', 'v0a', 'v0b', 'vab']
 
 def b14_parse(z_min=None, z_max=None, qual_cut=False, \
-        jla_path='/Users/sfeeney/Software_Packages/jla_v6/jla_likelihood_v6/data/'):
+        jla_path='/Users/sfeeney/Software_Packages/jla_v6/jla_likelihood_v6/data/', \
+        cache=True, cache_path=None):
+
+    # source files
+    lc_file = jla_path + 'jla_lcparams.txt'
+    cmat_files = [jla_path + 'jla_' + cmat + '_covmatrix.dat' for cmat in cmat_names]
+
+    # try the binary cache first: keyed by the source checksums and z-cuts
+    if cache:
+        if cache_path is None:
+            cache_path = jla_path + 'cache/'
+        cache_dir = os.path.join(cache_path, b14_cache_key([lc_file] + cmat_files, z_min, z_max, cache_path))
+        if os.path.exists(os.path.join(cache_dir, 'lcparams.npy')):
+            return b14_load_cache(cache_dir)
 
     # read lightcurve data
     #print '* reading B14 inputs'
-    data = np.genfromtxt(jla_path + 'jla_lcparams.txt', \
+    data = np.genfromtxt(lc_file, \
                          dtype = None, names = True)
     n_sn_in = len(data)
 
@@ -22,22 +42,84 @@ def b14_parse(z_min=None, z_max=None, qual_cut=False, \
     data = data[inds]
     n_sn = len(data)
 
-    # read V (non-diagonal) covariance matrices
-    cmats = {'v0': np.zeros((n_sn, n_sn)), \
-             'va': np.zeros((n_sn, n_sn)), \
-             'vb': np.zeros((n_sn, n_sn)), \
-             'v0a': np.zeros((n_sn, n_sn)), \
-             'v0b': np.zeros((n_sn, n_sn)), \
-             'vab': np.zeros((n_sn, n_sn))}
-    for cmat in cmats:
-        d = np.genfromtxt(jla_path + 'jla_' + cmat + '_covmatrix.dat')
-        #for i in range(n_sn):
-        #    cmats[cmat][i, :] = d[i * n_sn + 1: (i + 1) * n_sn + 1]
-        for i in range(n_sn):
-            cmats[cmat][i, :] = d[inds[0][i] * n_sn_in + 1 + inds[0]]
+    # read V (non-diagonal) covariance matrices: the first entry of each
+    # file is the matrix size, followed by the full matrix in row order
+    cmats = {}
+    for cmat, cmat_file in zip(cmat_names, cmat_files):
+        d = np.loadtxt(cmat_file)
+        cmats[cmat] = d[1:].reshape((n_sn_in, n_sn_in))[np.ix_(inds[0], inds[0])]
         #print np.allclose(cmats[cmat], cmats[cmat].T)
 #print '* B14 inputs read'
 
+    # write the binary cache for subsequent calls
+    if cache:
+        b14_save_cache(cache_dir, data, cmats)
+
+    return data, cmats
+
+def b14_cache_key(files, z_min, z_max, cache_path):
+
+    # checksums of the source files plus the z-cuts
+    checksums = b14_checksums(files, cache_path)
+    key = hashlib.sha1()
+    for f in files:
+        key.update('{}:{:08x};'.format(os.path.basename(f), checksums[f]).encode())
+    key.update('z_min={!r};z_max={!r}'.format(z_min, z_max).encode())
+    return key.hexdigest()
+
+def b14_checksums(files, cache_path):
+
+    # crc32 of each file, remembered against its size and modification time
+    # so unchanged sources are not re-read on every call
+    index_file = os.path.join(cache_path, 'checksums.json')
+    try:
+        with open(index_file) as fh:
+            index = json.load(fh)
+    except (IOError, ValueError):
+        index = {}
+    checksums = {}
+    updated = False
+    for f in files:
+        st = os.stat(f)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = index.get(os.path.abspath(f))
+        if entry is not None and entry[:2] == stamp:
+            checksums[f] = entry[2]
+            continue
+        checksum = 0
+        with open(f, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 24), b''):
+                checksum = zlib.crc32(chunk, checksum)
+        checksums[f] = checksum
+        index[os.path.abspath(f)] = stamp + [checksum]
+        updated = True
+    if updated:
+        os.makedirs(cache_path, exist_ok=True)
+        tmp = '{}.{:d}.tmp'.format(index_file, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(index, fh)
+        os.replace(tmp, index_file)
+    return checksums
+
+def b14_save_cache(cache_dir, data, cmats):
+
+    # write each array to a temporary file and move it into place, so
+    # concurrent writers (e.g. several MPI ranks) never expose a partial file;
+    # the light-curve table goes last as it marks the cache as complete
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    arrays = [(cmat, cmats[cmat]) for cmat in cmat_names] + [('lcparams', data)]
+    for name, array in arrays:
+        fname = os.path.join(cache_dir, name + '.npy')
+        tmp = '{}.{:d}.tmp.npy'.format(fname[:-4], os.getpid())
+        np.save(tmp, array)
+        os.replace(tmp, fname)
+
+def b14_load_cache(cache_dir):
+
+    # memory-mapped (read-only) so that processes on one node share pages
+    data = np.load(os.path.join(cache_dir, 'lcparams.npy'), mmap_mode='r')
+    cmats = {cmat: np.load(os.path.join(cache_dir, cmat + '.npy'), mmap_mode='r') for cmat in cmat_names}
     return data, cmats
 
 def b14_covariance(data, cmats, alpha, beta):
@@ -53,6 +135,69 @@ def b14_covariance(data, cmats, alpha, beta):
             2 * alpha * beta * data['cov_s_c']
     return c_mat + np.diag(d_mat)
 
+class B14Covariance():
+
+    def __init__(self, data, cmats, cache_size=16):
+
+        # Components V_i of C(alpha, beta) = sum_i c_i(alpha, beta) V_i, with the
+        # diagonal light-curve terms folded into the matching V matrix
+        diags = [data['dmb'] ** 2, data['dx1'] ** 2, data['dcolor'] ** 2, \
+                 data['cov_m_s'], data['cov_m_c'], data['cov_s_c']]
+        self.n_sn = len(data)
+        self.components = np.array([cmats[cmat] + np.diag(d) for cmat, d in zip(cmat_names, diags)])
+
+        # Cache of (C, L, logdet) for recently requested (alpha, beta)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    # Coefficients c_i(alpha, beta), shape (..., 6)
+    def coefficients(self, alpha, beta):
+
+        alpha = np.asarray(alpha, dtype=float)
+        beta = np.asarray(beta, dtype=float)
+        return np.stack([np.ones_like(alpha), alpha ** 2, beta ** 2, \
+                         2 * alpha, -2 * beta, -2 * alpha * beta], axis=-1)
+
+    # Covariance matrix for scalar or arrays of (alpha, beta), shape (..., n_sn, n_sn)
+    def covariance(self, alpha, beta):
+
+        return np.tensordot(self.coefficients(alpha, beta), self.components, axes=1)
+
+    # Covariance matrix, its Cholesky factor and log-determinant (cached)
+    def __call__(self, alpha, beta):
+
+        key = (float(alpha), float(beta))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        C = self.covariance(alpha, beta)
+        L = np.linalg.cholesky(C)
+        logdet = 2 * np.sum(np.log(np.diag(L)))
+        C.flags.writeable = False
+        L.flags.writeable = False
+
+        self.cache[key] = (C, L, logdet)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return C, L, logdet
+
+    # Batched version of __call__ for arrays of m (alpha, beta) pairs: returns
+    # C and L with shape (m, n_sn, n_sn) and logdet with shape (m,)
+    def batch(self, alpha, beta):
+
+        C = self.covariance(np.atleast_1d(alpha), np.atleast_1d(beta))
+        L = np.linalg.cholesky(C)
+        logdet = 2 * np.sum(np.log(np.diagonal(L, axis1=-2, axis2=-1)), axis=-1)
+        return C, L, logdet
+
+    # Derivatives of the covariance w.r.t. alpha and beta, shape (2, n_sn, n_sn)
+    def derivative(self, alpha, beta):
+
+        dc = np.array([[0, 2 * alpha, 0, 2, 0, -2 * beta], \
+                       [0, 0, 2 * beta, 0, -2, -2 * alpha]])
+        return np.tensordot(dc, self.components, axes=1)
+
 def b14_covariance_derivative(data, cmats, alpha, beta):
     
     n_sn = len(data)
@@ -1,10 +1,9 @@
 import numpy as np
-import scipy.integrate as integrate
 import simulators.jla_supernovae.jla_parser as jla_parser
 
 class JLA_Model():
 
-    def __init__(self, jla_data_path = 'simulators/jla_supernovae/jla_data/'):
+    def __init__(self, jla_data_path = 'simulators/jla_supernovae/jla_data/', vary_covariance = False):
 
         # Import data
         jla_data, jla_cmats = jla_parser.b14_parse(z_min=None, z_max=None, qual_cut=False,
@@ -13,14 +12,23 @@ class JLA_Model():
         delta_m_cut = 10
         self.auxiliary_data = np.column_stack([jla_data['zcmb'], jla_data['x1'], jla_data['color'], np.array([(jla_data['3rdvar'] > delta_m_cut)], dtype=int)[0]])
 
+        # Redshift grid for the distance integrals: a fine uniform grid merged with
+        # the supernova redshifts, so the cumulative integral lands on every supernova
+        z = self.auxiliary_data[:,0]
+        self.z_grid, z_index = np.unique(np.concatenate([np.linspace(0, z.max(), 2000), z]), return_inverse=True)
+        self.z_index = z_index[-len(z):]
+
         # Om, w0, M_b, alpha, beta, delta_m
         self.npar = 6
         self.theta_fiducial = np.array([  0.20181324,  -0.74762939, -19.04253368,   0.12566322,   2.64387045, -0.05252869])
 
-        # Covariance matrix
-        self.C = jla_parser.b14_covariance(jla_data, jla_cmats, self.theta_fiducial[3], self.theta_fiducial[4])
+        # Covariance matrix (and engine for alpha/beta-dependent covariances)
+        self.covariance = jla_parser.B14Covariance(jla_data, jla_cmats)
+        self.C, self.L, self.logdetC = self.covariance(self.theta_fiducial[3], self.theta_fiducial[4])
         self.Cinv = np.linalg.inv(self.C)
-        self.L = np.linalg.cholesky(self.C)
+
+        # Draw the noise from C(alpha, beta) at the simulated parameters rather than the fiducial C?
+        self.vary_covariance = vary_covariance
 
         # Derivative of the covariance matrix
         self.n_sn = len(self.C)
@@ -52,26 +60,31 @@ class JLA_Model():
         c = self.auxiliary_data[:,2]
         v3 = self.auxiliary_data[:,3]
         
-        # Holders
-        distance_modulus = np.zeros(len(z))
-        
-        for i in range(len(z)):
-            integral = integrate.quad(lambda zz: 1./np.sqrt( Om*(1+zz)**3 + (1-Om)*(1+zz)**(3*(1+w0)) ), 0, z[i])[0]
-            distance_modulus[i] = 25 - 5*np.log10(h) + 5*np.log10(3000*(1+z[i])*integral)
+        # Integrate 1/E(z) cumulatively over the redshift grid (trapezoid rule)
+        zz = self.z_grid
+        E_inv = 1./np.sqrt( Om*(1+zz)**3 + (1-Om)*(1+zz)**(3*(1+w0)) )
+        integral = np.concatenate([[0.], np.cumsum(0.5*(E_inv[1:] + E_inv[:-1])*np.diff(zz))])[self.z_index]
+        distance_modulus = 25 - 5*np.log10(h) + 5*np.log10(3000*(1+z)*integral)
         
         return Mb - alpha*x + beta*c + delta_m*v3 + distance_modulus
 
     # Generate realisation of \mu
     def simulation(self, theta, seed):
         
-        # Set the seed
-        np.random.seed(seed)
+        return self.simulate_batch(theta, seed, 1)[0]
+
+    # Generate a batch of n realisations of \mu at the same parameters
+    def simulate_batch(self, theta, seed, n):
+        
+        # Local random state (leaves the global numpy RNG untouched)
+        state = np.random.RandomState(seed)
 
-        # Signal
+        # Signal (shared by the whole batch)
         mb = self.apparent_magnitude(theta)
         
-        # Noise
-        noise = np.dot(self.L, np.random.normal(0, 1, len(self.L)))
+        # Noise for the whole batch with a single matmul against the Cholesky factor
+        L = self.covariance(theta[3], theta[4])[1] if self.vary_covariance else self.L
+        noise = np.dot(state.normal(0, 1, (n, len(L))), L.T)
         
         # Return signal + noise
         return mb + noise
@@ -1,22 +1,54 @@
 import numpy as np
 import numpy.linalg as linalg
+import scipy.linalg
 
 # Generate covariance matrix
 def covariance(theta_fiducial, simulation, nsims, ndata, sim_args):
     
-    C = np.zeros((ndata,ndata))
     D = np.zeros((nsims, ndata))
-    dbar = np.zeros((ndata))
-    d2bar = np.zeros((ndata, ndata))
     for i in range(0, nsims):
-        sim = simulation(theta_fiducial, sim_args)
-        dbar += sim/nsims
-        d2bar += np.outer(sim, sim)/nsims
-        D[i,:] = sim
-    C = d2bar - np.outer(dbar,dbar)
+        D[i,:] = simulation(theta_fiducial, sim_args)
+    dbar, C = mean_covariance(D)
         
     return dbar, C, D
 
+# Mean and (maximum likelihood) covariance of a stacked (nsims, ndata) array of simulations
+def mean_covariance(D):
+    
+    dbar = np.mean(D, axis=0)
+    R = D - dbar
+    C = np.dot(R.T, R)/len(D)
+    
+    return dbar, C
+
+# Running mean and covariance, for streaming batches of simulations through
+class StreamingCovariance():
+    
+    def __init__(self, ndata):
+        
+        self.n = 0
+        self.mean = np.zeros(ndata)
+        self.M2 = np.zeros((ndata, ndata))
+    
+    # Add a (nsims, ndata) batch (pairwise merge of the batch moments with the running ones)
+    def update(self, D):
+        
+        D = np.atleast_2d(D)
+        n_batch = len(D)
+        mean_batch = np.mean(D, axis=0)
+        R = D - mean_batch
+        delta = mean_batch - self.mean
+        n = self.n + n_batch
+        self.M2 += np.dot(R.T, R) + np.outer(delta, delta)*self.n*n_batch/n
+        self.mean += delta*n_batch/n
+        self.n = n
+    
+    # Current (maximum likelihood) covariance
+    @property
+    def C(self):
+        
+        return self.M2/self.n
+
 # Generate derivative of \mu w.r.t cosmological parameters
 def dmudtheta(theta_fiducial, simulation_seeded, step, npar, ndata, sim_args):
     
@@ -45,52 +77,34 @@ def dmudtheta(theta_fiducial, simulation_seeded, step, npar, ndata, sim_args):
 # Compute the moped compression vectors from the covariance and dmudtheta
 def moped_matrix_gram_schmidt(Cinv, dmdt, npar, ndata):
     
-    # moped vectors
-    B = np.zeros((npar, ndata))
-    
-    # First vector
-    B[0,:] = np.dot(Cinv, dmdt[0,:])/np.sqrt(np.dot(dmdt[0,:],np.dot(Cinv, dmdt[0,:])))
-    
-    # Subsequent vectors with Gram-Schmidt orthogonalization
-    for i in range(1, npar):
-        
-        # Compute the Gram-Schmidt orthogonal component
-        X = np.zeros((ndata))
-        for j in range(0, i):
-            X += np.dot(dmdt[i,:], B[j,:])*B[j,:]
-            
-        # Construce the MOPED vector
-        B[i,:] = (np.dot(Cinv, dmdt[i,:]) - X)/np.sqrt(np.dot(dmdt[i,:], np.dot(Cinv, dmdt[i,:]) - X))
+    # Gram-Schmidt orthogonalization of the Cinv dmdt in the C metric, in one go:
+    # with F = dmdt Cinv dmdt^T = L L^T, the rows of B = L^{-1} dmdt Cinv satisfy B C B^T = I
+    # and row i only involves dmdt[0..i], exactly as the sequential Gram-Schmidt vectors
+    CinvdmdtT = np.dot(dmdt, Cinv)
+    L = np.linalg.cholesky(np.dot(CinvdmdtT, dmdt.T))
+    B = scipy.linalg.solve_triangular(L, CinvdmdtT, lower=True)
     
     return B
 
 # Compute the moped compression vectors from the covariance and dmudtheta
 def moped_matrix(Cinv, dmdt, npar, ndata):
     
-    # moped vectors
-    B = np.zeros((npar, ndata))
-    
-    # Subsequent vectors with Gram-Schmidt orthogonalization
-    for a in range(0, npar):
-        B[a,:] = np.dot(Cinv, dmdt[a,:])
+    # moped vectors (Cinv is symmetric)
+    B = np.dot(dmdt, Cinv)
 
     return B
 
 # Compute the Fisher matrix
 def fisher(dmdt, dCdt, Cinv, Sinv, npar):
     
-    # Fisher matrix
-    F = np.zeros((npar, npar))
-    
     # Mean derivatives part
-    for a in range(0, npar):
-        for b in range(0, npar):
-            F[a, b] += 0.5*(np.dot(dmdt[a,:], np.dot(Cinv, dmdt[b,:])) + np.dot(dmdt[b,:], np.dot(Cinv, dmdt[a,:])))
+    F = np.dot(dmdt, np.dot(Cinv, dmdt.T))
+    F = 0.5*(F + F.T)
 
-    # Covariance derivatives part
-    for a in range(0, npar):
-        for b in range(0, npar):
-            F[a, b] += 0.5*np.trace( np.dot( np.dot(Cinv, dCdt[a,:,:]), np.dot(Cinv, dCdt[b,:,:]) ) )
+    # Covariance derivatives part: 0.5 Tr(Cinv dCdt_a Cinv dCdt_b)
+    if np.any(dCdt):
+        CinvdCdt = np.matmul(Cinv, dCdt)
+        F += 0.5*np.einsum('aij,bji->ab', CinvdCdt, CinvdCdt)
 
     # Add the prior
     F = F + Sinv
@@ -99,23 +113,43 @@ def fisher(dmdt, dCdt, Cinv, Sinv, npar):
     return F, Finv
 
 # Compute the maximum likelihood estimator assuming Gaussianity and linearity
+# (data can be a single data vector or a (N, ndata) batch)
 def mle(theta_fiducial, Finv, Cinv, dmdt, dCdt, mu, Sinv, mu_prior, data):
     
-    # Number of parameters
-    npar = len(theta_fiducial)
+    return MOPEDCompressor(theta_fiducial, Finv, Cinv, dmdt, dCdt, mu, Sinv, mu_prior)(data)
+
+# Score (MLE) compression with all the data-independent pieces precomputed, so a
+# (N, ndata) batch is compressed with a single matmul (plus the covariance-derivative
+# quadratic terms when dCdt is non-zero). Instances can be passed directly to Delfi
+# as a batched compressor.
+class MOPEDCompressor():
     
-    # Compute the score
-    dLdt = np.zeros(npar)
+    batched = True
     
-    # Add terms from mean derivatives
-    for a in range(npar):
-        dLdt[a] += np.dot(dmdt[a,:], np.dot(Cinv, (data - mu)))
-
-    # Add terms from covariance derivatives
-    for a in range(npar):
-        dLdt[a] += -0.5*np.trace(np.dot(Cinv, dCdt[a,:,:])) + 0.5*np.dot((data - mu), np.dot( np.dot(Cinv, np.dot(dCdt[a,:,:], Cinv)), (data - mu)))
-
-    return theta_fiducial + np.dot(Finv, np.dot(Sinv, mu_prior - theta_fiducial)) + np.dot(Finv, dLdt)
+    def __init__(self, theta_fiducial, Finv, Cinv, dmdt, dCdt, mu, Sinv, mu_prior):
+        
+        self.mu = mu
+        
+        # Linear part: t = theta_fiducial + Finv Sinv (mu_prior - theta_fiducial) + Finv dmdt Cinv (d - mu) + ...
+        self.A = np.dot(Finv, np.dot(dmdt, Cinv))
+        self.b = theta_fiducial + np.dot(Finv, np.dot(Sinv, mu_prior - theta_fiducial))
+        
+        # Covariance derivatives part: Finv [-0.5 Tr(Cinv dCdt_a) + 0.5 (d - mu) Cinv dCdt_a Cinv (d - mu)]
+        if dCdt is not None and np.any(dCdt):
+            self.b = self.b - 0.5*np.dot(Finv, np.trace(np.matmul(Cinv, dCdt), axis1=1, axis2=2))
+            self.Q = 0.5*np.einsum('ab,bij->aij', Finv, np.matmul(np.matmul(Cinv, dCdt), Cinv))
+        else:
+            self.Q = None
+    
+    # Compress a single data vector or a (N, ndata) batch
+    def __call__(self, data, args=None):
+        
+        r = np.asarray(data) - self.mu
+        t = self.b + np.dot(r, self.A.T)
+        if self.Q is not None:
+            t = t + np.einsum('...i,aij,...j->...a', r, self.Q, r)
+        
+        return t
 
 # Compute the compressed data
 def compressed(data, index, compression_args):
@@ -132,23 +166,7 @@ def compressed(data, index, compression_args):
 def compressed_gram_schmidt(data, Cinv, dmdt):
 
     # moped vectors
-    npar = len(dmdt)
-    ndata = len(data)
-    B = np.zeros((npar, ndata))
-    
-    # First vector
-    B[0,:] = np.dot(Cinv, dmdt[0,:])/np.sqrt(np.dot(dmdt[0,:],np.dot(Cinv, dmdt[0,:])))
-    
-    # Subsequent vectors with Gram-Schmidt orthogonalization
-    for i in range(1, npar):
-        
-        # Compute the Gram-Schmidt orthogonal component
-        X = np.zeros((ndata))
-        for j in range(0, i):
-            X += np.dot(dmdt[i,:], B[j,:])*B[j,:]
-        
-        # Construce the MOPED vector
-        B[i,:] = (np.dot(Cinv, dmdt[i,:]) - X)/np.sqrt(np.dot(dmdt[i,:], np.dot(Cinv, dmdt[i,:]) - X))
+    B = moped_matrix_gram_schmidt(Cinv, dmdt, len(dmdt), np.shape(data)[-1])
     
-    return np.dot(B, data)
+    return np.dot(data, B.T)
 
@@ -3,15 +3,36 @@ import getdist
 from getdist import plots, MCSamples
 import pydelfi.ndes
 import pydelfi.train
+import pydelfi.inference
 import emcee
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import pydelfi.priors as priors
 import numpy as np
 from tqdm.auto import tqdm
-import scipy.optimize as optimization
 from scipy.stats import multivariate_normal
+from scipy.special import logsumexp
 import pickle
+import collections
+import copy
+import concurrent.futures
+import time
+import warnings
+from pydelfi.workers import simulate_and_compress, SimulationWorker, stacked_log_density, ParallelLogDensity
+
+# n draws from a prior/proposal density, in one batched call for the priors in pydelfi.priors
+def draw_samples(density, n):
+
+    if isinstance(density, (priors.Uniform, priors.TruncatedGaussian)):
+        return density.draw(n)
+    return np.array([density.draw() for i in range(n)])
+
+# Effective number of samples for each parameter of a chain of shape (steps, walkers/chains, npar),
+# from the integrated autocorrelation time
+def effective_sample_size(chain):
+
+    tau = emcee.autocorr.integrated_time(chain, tol = 0, quiet = True)
+    return chain.shape[0]*chain.shape[1]/tau
 
 class Delfi():
 
@@ -20,7 +41,10 @@ class Delfi():
                  posterior_chain_length = 1000, proposal_chain_length = 100, \
                  rank = 0, n_procs = 1, comm = None, red_op = None, \
                  show_plot = True, results_dir = "", progress_bar = True, input_normalization = None,
-                 graph_restore_filename = "graph_checkpoint", restore_filename = "restore.pkl", restore = False, save = True):
+                 graph_restore_filename = "graph_checkpoint", restore_filename = "restore.pkl", restore = False, save = True, \
+                 lr_schedule = None, sampler = 'emcee', target_ess = None, max_sampling_time = None, max_sampling_steps = None, \
+                 reuse_samples = False, min_reuse_ess = 0.5, refresh_burn_in = 20, \
+                 importance_sampling = False, min_importance_ess = 0.1, parallel_sampling = None, n_sampling_processes = None):
         
         # Input validation
         for i in range(len(nde)):
@@ -61,7 +85,8 @@ class Delfi():
         # Initialize the NDEs, trainers, and stacking weights (for stacked density estimators)
         self.n_ndes = len(nde)
         self.nde = nde
-        self.trainer = [pydelfi.train.ConditionalTrainer(nde[i]) for i in range(self.n_ndes)]
+        # (each trainer gets its own copy of the learning-rate schedule, since schedules are stateful)
+        self.trainer = [pydelfi.train.ConditionalTrainer(nde[i], schedule=copy.deepcopy(lr_schedule)) for i in range(self.n_ndes)]
         self.stacking_weights = np.zeros(self.n_ndes)
 
         # Tensorflow session for the NDE training
@@ -105,11 +130,11 @@ class Delfi():
         else:
             self.x_mean, self.x_std, self.p_mean, self.p_std = input_normalization
 
-        # Training data [initialize empty]
-        self.ps = np.array([]).reshape(0,self.npar)
-        self.xs = np.array([]).reshape(0,self.D)
-        self.x_train = tf.placeholder(tf.float32, shape = (None, self.npar))
-        self.y_train = tf.placeholder(tf.float32, shape = (None, self.D))
+        # Training data [initialize empty]: ps, xs (and their float32 copies x_train, y_train)
+        # are views into buffers that grow geometrically as simulations are appended
+        self.training_buffers = [np.zeros((0,self.npar)), np.zeros((0,self.D)), \
+                                 np.zeros((0,self.npar), dtype=np.float32), np.zeros((0,self.D), dtype=np.float32)]
+        self.ps, self.xs, self.x_train, self.y_train = self.training_buffers
         self.n_sims = 0
         
         # MCMC chain parameters for EMCEE
@@ -119,13 +144,14 @@ class Delfi():
         
         # Initialize MCMC chains for posterior and proposal
         if self.asymptotic_posterior is not None:
-            self.posterior_samples = np.array([self.asymptotic_posterior.draw() for i in range(self.nwalkers*self.posterior_chain_length)])
-            self.proposal_samples = np.array([self.asymptotic_posterior.draw() for i in range(self.nwalkers*self.proposal_chain_length)])
+            self.posterior_samples = draw_samples(self.asymptotic_posterior, self.nwalkers*self.posterior_chain_length)
+            self.proposal_samples = draw_samples(self.asymptotic_posterior, self.nwalkers*self.proposal_chain_length)
         else:
-            self.posterior_samples = np.array([self.prior.draw() for i in range(self.nwalkers*self.posterior_chain_length)])
-            self.proposal_samples = np.array([self.prior.draw() for i in range(self.nwalkers*self.proposal_chain_length)])
+            self.posterior_samples = draw_samples(self.prior, self.nwalkers*self.posterior_chain_length)
+            self.proposal_samples = draw_samples(self.prior, self.nwalkers*self.proposal_chain_length)
         self.posterior_weights = np.ones(len(self.posterior_samples))*1.0/len(self.posterior_samples)
         self.proposal_weights = np.ones(len(self.proposal_samples))*1.0/len(self.proposal_samples)
+        self.posterior_log_density = None
     
         # Parameter names and ranges for plotting with GetDist
         self.names = param_names
@@ -163,21 +189,73 @@ class Delfi():
         # Save attributes of the ojbect as you go?
         self.save = save
 
+        # MCMC sampler for the posterior and proposal densities ('emcee' or 'hmc'), and a record of the
+        # wall time and effective samples per second of each sampling run
+        if sampler not in ['emcee', 'hmc']:
+            raise ValueError("sampler must be 'emcee' or 'hmc'")
+        self.sampler = sampler
+        self.sampling_stats = []
+        self.nde_gradients = {}
+
+        # Convergence-aware emcee sampling: run until target_ess effective samples (or max_sampling_time
+        # seconds, or max_sampling_steps steps), warm-starting from the walker state left by the previous run
+        # for the same density
+        self.target_ess = target_ess
+        self.max_sampling_time = max_sampling_time
+        self.max_sampling_steps = max_sampling_steps
+        self.walker_states = {}
+
+        # Reuse the previous posterior/proposal samples after retraining, reweighted by the density ratio,
+        # while their effective sample size stays above min_reuse_ess (as a fraction of the samples);
+        # otherwise refresh them with a chain warm-started from the previous walkers (refresh_burn_in steps)
+        self.reuse_samples = reuse_samples
+        self.min_reuse_ess = min_reuse_ess
+        self.refresh_burn_in = refresh_burn_in
+
+        # Update the posterior after retraining by importance weights (posterior_weights) on the existing
+        # posterior samples, re-running the MCMC only when their effective sample size falls below
+        # min_importance_ess (as a fraction of the samples)
+        self.importance_sampling = importance_sampling
+        self.min_importance_ess = min_importance_ess
+
+        # Spread the emcee walker evaluations over the MPI ranks ('mpi', in sequential_training, where the
+        # other ranks would otherwise wait for rank 0) or over n_sampling_processes local processes ('processes')
+        if parallel_sampling not in [None, 'mpi', 'processes']:
+            raise ValueError("parallel_sampling must be None, 'mpi' or 'processes'")
+        self.parallel_sampling = parallel_sampling
+        self.n_sampling_processes = n_sampling_processes
+        self.sampling_pool = None
+        self.mpi_serving = False
+
         # Restore the graph and dynamic object attributes if restore = True
         if restore == True:
             
             # Restore the graph
             saver = tf.train.Saver()
             saver.restore(self.sess, self.graph_restore_filename)
+            for nde in self.nde:
+                if hasattr(nde, 'refresh_inference_weights'):
+                    nde.refresh_inference_weights(self.sess)
 
             # Restore the dynamic object attributes
-            self.stacking_weights, self.posterior_samples, self.proposal_samples, self.training_loss, self.validation_loss, self.stacked_sequential_training_loss, self.stacked_sequential_validation_loss, self.sequential_nsims, self.ps, self.xs, self.x_mean, self.x_std, self.p_mean, self.p_std = pickle.load(open(self.restore_filename, 'rb'))
+            attributes = pickle.load(open(self.restore_filename, 'rb'))
+            self.stacking_weights, self.posterior_samples, self.proposal_samples, self.training_loss, self.validation_loss, self.stacked_sequential_training_loss, self.stacked_sequential_validation_loss, self.sequential_nsims, ps, xs, self.x_mean, self.x_std, self.p_mean, self.p_std = attributes[:14]
+            self.append_simulations(xs, ps)
+
+            # Files saved before the sample weights were kept hold uniformly weighted samples
+            if len(attributes) > 14:
+                self.posterior_weights, self.proposal_weights, self.posterior_log_density = attributes[14:]
+            else:
+                self.posterior_weights = np.ones(len(self.posterior_samples))*1.0/len(self.posterior_samples)
+                self.proposal_weights = np.ones(len(self.proposal_samples))*1.0/len(self.proposal_samples)
+                self.posterior_log_density = None
 
     # Save object attributes
     def saver(self):
     
         f = open(self.restore_filename, 'wb')
-        pickle.dump([self.stacking_weights, self.posterior_samples, self.proposal_samples, self.training_loss, self.validation_loss, self.stacked_sequential_training_loss, self.stacked_sequential_validation_loss, self.sequential_nsims, self.ps, self.xs, self.x_mean, self.x_std, self.p_mean, self.p_std], f)
+        pickle.dump([self.stacking_weights, self.posterior_samples, self.proposal_samples, self.training_loss, self.validation_loss, self.stacked_sequential_training_loss, self.stacked_sequential_validation_loss, self.sequential_nsims, self.ps, self.xs, self.x_mean, self.x_std, self.p_mean, self.p_std, \
+                     self.posterior_weights, self.proposal_weights, self.posterior_log_density], f)
         f.close()
     
     # Divide list of jobs between MPI processes
@@ -223,6 +301,18 @@ class Delfi():
         lnL[np.isnan(lnL)[:,0],:] = -1e300
         return lnL
 
+    # Export the NDEs and the stacked likelihood/posterior to NumPy (no tensorflow session needed, picklable)
+    def export_likelihood(self, dtype=np.float64):
+
+        return pydelfi.inference.StackedLikelihood([nde.export(self.sess, dtype) for nde in self.nde], self.stacking_weights, \
+                                                   self.p_mean, self.p_std, self.x_mean, self.x_std, self.prior)
+
+    # Emulated simulations: n draws of (unnormalized) data from the stacked NDE likelihood for each row of theta
+    def sample_data(self, theta, n=1):
+
+        x = np.atleast_2d((theta - self.p_mean)/self.p_std)
+        return pydelfi.inference.sample_stacked(self.nde, self.stacking_weights, x, n, self.sess)*self.x_std + self.x_mean
+
     # Log posterior (stacked)
     def log_posterior_stacked(self, theta, data):
         
@@ -238,38 +328,184 @@ class Delfi():
         
         return 0.5 * (self.log_likelihood_stacked(x, data) + 2 * self.prior.logpdf(np.atleast_2d(x)) )
 
-    # Bayesian optimization acquisition function
+    # NDE log likelihood (stacked) for many data sets at once, in one batched NDE call per NDE: theta has
+    # shape (n_theta, npar) (shared by all data sets) or (n_data, n_theta, npar), data has shape (n_data, D).
+    # Returns log likelihoods of shape (n_data, n_theta)
+    def log_likelihood_multi(self, theta, data):
+
+        data = np.atleast_2d(data)
+        theta = np.broadcast_to(np.atleast_2d(theta), (len(data),) + np.atleast_2d(theta).shape[-2:])
+        n_data, n_theta = theta.shape[:2]
+        x = ((theta - self.p_mean)/self.p_std).reshape(-1, self.npar)
+        y = np.repeat((data - self.x_mean)/self.x_std, n_theta, axis=0)
+        lnL = logsumexp(np.concatenate([self.nde[n].eval((x, y), self.sess) for n in range(self.n_ndes)], axis=1), b=self.stacking_weights, axis=1)
+        lnL[np.isnan(lnL)] = -1e300
+        return lnL.reshape(n_data, n_theta)
+
+    # Log posterior (stacked) for many data sets at once (shapes as log_likelihood_multi)
+    def log_posterior_multi(self, theta, data):
+
+        lnL = self.log_likelihood_multi(theta, data)
+        theta = np.broadcast_to(np.atleast_2d(theta), lnL.shape + (self.npar,))
+        return lnL + self.prior.logpdf(theta.reshape(-1, self.npar)).reshape(lnL.shape)
+
+    # Affine-invariant ensemble (stretch move) sampler run for many data sets simultaneously: each data set
+    # has its own ensemble of walkers, and every half-step evaluates the proposals for all data sets in a
+    # single call to log_posterior(theta, data) (default: log_posterior_multi). Returns the chains with
+    # shape (n_data, main_chain*nwalkers, npar)
+    def ensemble_sample_multi(self, data, log_posterior=None, x0=None, burn_in_chain=100, main_chain=1000, nwalkers=None, a=2.):
+
+        # Set the log posterior (default to the stacked NDE posterior)
+        if log_posterior is None:
+            log_posterior = self.log_posterior_multi
+        data = np.atleast_2d(data)
+        n_data = len(data)
+
+        # Set up default x0: the same walkers (from the current posterior samples) for every data set
+        if nwalkers is None:
+            nwalkers = self.nwalkers if x0 is None else np.shape(x0)[-2]
+        if x0 is None:
+            x0 = self.posterior_samples[np.random.choice(len(self.posterior_samples), nwalkers, replace = False),:]
+        x = np.array(np.broadcast_to(x0, (n_data, nwalkers, self.npar)), dtype = np.float64)
+        lp = log_posterior(x, data)
+        lp[np.isnan(lp)] = -np.inf
+
+        # Walkers are updated in two halves, each using the other half as the complementary ensemble
+        halves = [np.arange(0, nwalkers//2), np.arange(nwalkers//2, nwalkers)]
+        chain = np.zeros((n_data, main_chain, nwalkers, self.npar))
+        for step in range(burn_in_chain + main_chain):
+            for active, complement in [halves, halves[::-1]]:
+                n = len(active)
+                z = ((a - 1.)*np.random.uniform(0, 1, (n_data, n)) + 1)**2/a
+                partners = np.take_along_axis(x[:, complement, :], np.random.randint(len(complement), size = (n_data, n, 1)), axis = 1)
+                proposal = partners + z[:,:,np.newaxis]*(x[:, active, :] - partners)
+                lp_proposal = log_posterior(proposal, data)
+                lp_proposal[np.isnan(lp_proposal)] = -np.inf
+                accept = np.log(np.random.uniform(0, 1, (n_data, n))) < (self.npar - 1)*np.log(z) + lp_proposal - lp[:, active]
+                x[:, active, :] = np.where(accept[:,:,np.newaxis], proposal, x[:, active, :])
+                lp[:, active] = np.where(accept, lp_proposal, lp[:, active])
+            if step >= burn_in_chain:
+                chain[:, step - burn_in_chain] = x
+
+        return chain.reshape(n_data, main_chain*nwalkers, self.npar)
+
+    # Bayesian optimization acquisition function: stacked log posterior times the (stacking-weighted)
+    # spread of the individual NDEs' log posteriors, for rows of theta
     def acquisition(self, theta):
 
-        # Compute log_posteriors
-        Ls = np.array([self.log_posterior_individual(i, theta) for i in range(self.n_ndes)])
-    
-        # Check whether prior is zero or not
-        return self.log_posterior_stacked(theta)*np.sqrt(np.average((Ls - np.average(Ls, weights = self.stacking_weights, axis=0))**2, weights=self.stacking_weights, axis=0))
+        return self.acquisition_gradient(theta)[0]
+
+    # Gradient of the prior log density for many rows of theta: the prior's logpdf_gradient if it has one,
+    # otherwise central finite differences of its logpdf (steps of 1e-5 p_std; zero where a step leaves the
+    # parameter limits, across which the logpdf drops to -inf or -1e300)
+    def prior_logpdf_gradient(self, theta):
+
+        if hasattr(self.prior, 'logpdf_gradient'):
+            return self.prior.logpdf_gradient(theta)
+        h = 1e-5*self.p_std
+        grad = np.zeros(theta.shape)
+        for j in range(self.npar):
+            dtheta = np.zeros(self.npar)
+            dtheta[j] = h[j]
+            inside = (theta[:,j] - h[j] > self.lower[j])*(theta[:,j] + h[j] < self.upper[j])
+            grad[inside,j] = (self.prior.logpdf(theta[inside] + dtheta) - self.prior.logpdf(theta[inside] - dtheta))/(2*h[j])
+        grad[~np.isfinite(grad)] = 0
+        return grad
+
+    # Acquisition function and its gradient with respect to theta for many rows of theta at once (one
+    # batched tensorflow call for all NDEs). The prior cancels in the spread of the NDE log posteriors,
+    # so with A = lnP sigma: grad A = sigma grad lnP + lnP grad sigma, where
+    # grad sigma = sum_n w_n (L_n - <L>)(grad L_n - <grad L>)/sigma
+    def acquisition_gradient(self, theta):
+
+        theta = np.atleast_2d(theta)
+        L, grads = self.log_likelihood_gradient_individual(theta, self.data)
+        w = self.stacking_weights/np.sum(self.stacking_weights)
+
+        # Stacked log posterior and gradient
+        lnL = logsumexp(L, b=w, axis=1)
+        responsibilities = w*np.exp(L - lnL[:,np.newaxis])
+        lnP = lnL + self.prior.logpdf(theta)
+        grad_lnP = np.einsum('in,nij->ij', responsibilities, grads) + self.prior_logpdf_gradient(theta)
+
+        # Spread of the individual log posteriors and its gradient
+        dL = L - np.dot(L, w)[:,np.newaxis]
+        dgrads = grads - np.einsum('n,nij->ij', w, grads)
+        sigma = np.sqrt(np.dot(dL**2, w))
+        grad_sigma = np.einsum('n,in,nij->ij', w, dL, dgrads)/np.maximum(sigma, 1e-300)[:,np.newaxis]
+
+        A = lnP*sigma
+        grad_A = sigma[:,np.newaxis]*grad_lnP + lnP[:,np.newaxis]*grad_sigma
+        bad = ~np.isfinite(A)
+        A[bad] = -np.inf
+        grad_A[bad] = 0
+        return A, grad_A
+
+    # Batch of n_points distinct acquisition points: score n_candidates candidates (drawn half from the
+    # current posterior samples, half from the prior) in one batched call, run projected gradient ascent
+    # (Adam, in units of p_std) from the n_starts best of them in parallel, then greedily pick the
+    # highest-acquisition points at least min_separation (in units of p_std) apart
+    def optimize_acquisition(self, n_points, n_candidates=4096, n_starts=64, n_steps=100, learning_rate=0.05, min_separation=0.1):
+
+        # Keep the points strictly inside the parameter limits
+        lower, upper = np.nextafter(self.lower, self.upper), np.nextafter(self.upper, self.lower)
+
+        # Score the candidates
+        candidates = np.concatenate([self.posterior_samples[np.random.randint(len(self.posterior_samples), size = n_candidates//2),:], \
+                                     draw_samples(self.prior, n_candidates - n_candidates//2)])
+        candidates = np.clip(candidates, lower, upper)
+        A_candidates = self.acquisition(candidates)
+
+        # Multi-start gradient ascent from the best candidates
+        n_starts = max(min(n_starts, n_candidates), n_points)
+        theta = candidates[np.argsort(-A_candidates)[:n_starts],:]
+        A, grad = self.acquisition_gradient(theta)
+        theta_best, A_best = theta.copy(), A.copy()
+        m, v = np.zeros(theta.shape), np.zeros(theta.shape)
+        for step in range(1, n_steps + 1):
+            g = grad*self.p_std
+            m = 0.9*m + 0.1*g
+            v = 0.999*v + 0.001*g**2
+            theta = np.clip(theta + learning_rate*self.p_std*(m/(1 - 0.9**step))/(np.sqrt(v/(1 - 0.999**step)) + 1e-8), lower, upper)
+            A, grad = self.acquisition_gradient(theta)
+            improved = A > A_best
+            theta_best[improved], A_best[improved] = theta[improved], A[improved]
+
+        # Greedy selection of diverse points, from the optima and the scored candidates
+        points = np.concatenate([theta_best, candidates])
+        scores = np.concatenate([A_best, A_candidates])
+        order = np.argsort(-scores)
+        selected = []
+        for k in order:
+            if len(selected) == n_points:
+                break
+            if all(np.sqrt(np.sum(((points[k] - points[j])/self.p_std)**2)) >= min_separation for j in selected):
+                selected.append(k)
+
+        # Not enough well-separated points: fill up with the best remaining ones
+        for k in order:
+            if len(selected) == n_points:
+                break
+            if k not in selected:
+                selected.append(k)
+        return points[selected], scores[selected]
                 
     # Bayesian optimization training
     def bayesian_optimization_training(self, simulator, compressor, n_batch, n_populations, n_optimizations = 10, \
                                        simulator_args = None, compressor_args = None, plot = False, batch_size = 100, \
                                        validation_split = 0.1, epochs = 300, patience = 20, seed_generator = None, \
-                                       save_intermediate_posteriors = False, sub_batch = 1):
+                                       save_intermediate_posteriors = False, sub_batch = 1, n_candidates = 4096, min_separation = 0.1):
     
         # Loop over n_populations
         for i in range(n_populations):
     
-            # Find acquisition point...
-            print('Finding optimal acquisition point...')
-            A_optimal = 0
-            theta_optimal = self.theta_fiducial
-            for i in range(n_optimizations):
-                res = optimization.basinhopping(lambda x: -self.acquisition(x), x0=self.theta_fiducial)
-                if res.fun < A_optimal:
-                    A_optimal = res.fun
-                    theta_optimal = res.x
-        
-            # Array of parameters to run simulations
-            ps = np.array([theta_optimal for k in range(n_batch)])
+            # Find a batch of n_batch distinct acquisition points (n_optimizations gradient ascents per point)
+            print('Finding optimal acquisition points...')
+            ps, A = self.optimize_acquisition(n_batch, n_candidates=n_candidates, n_starts=n_optimizations*n_batch, min_separation=min_separation)
+            self.inds_prop = self.allocate_jobs(n_batch)
+            self.inds_acpt = self.allocate_jobs(n_batch)
             
-            # Run a small batch of simulations at the acquisition point
+            # Run a small batch of simulations at the acquisition points
             xs_batch, ps_batch = self.run_simulation_batch(n_batch, ps, simulator, compressor, simulator_args, compressor_args, seed_generator = seed_generator, sub_batch = sub_batch)
             
             # Augment the training data
@@ -288,7 +524,8 @@ class Delfi():
                 self.saver()
     
     # Run n_batch simulations
-    def run_simulation_batch(self, n_batch, ps, simulator, compressor, simulator_args, compressor_args, seed_generator = None, sub_batch = 1):
+    def run_simulation_batch(self, n_batch, ps, simulator, compressor, simulator_args, compressor_args, seed_generator = None, sub_batch = 1, \
+                             timeout = None, max_retries = 0, max_failures = None, return_report = False):
         
         # Random seed generator: set to unsigned 32 bit int random numbers as default
         if seed_generator is None:
@@ -298,40 +535,254 @@ class Delfi():
         data_samples = np.zeros((n_batch*sub_batch, self.D))
         parameter_samples = np.zeros((n_batch*sub_batch, self.npar))
         
-        # Run samples assigned to each process, catching exceptions
-        # (when simulator returns np.nan).
+        # Per-simulation timeouts (in seconds) need the simulator to run in a separate
+        # worker process, which is killed and replaced when a simulation overruns
+        worker = None
+        if timeout is not None:
+            worker = SimulationWorker(simulator, compressor, simulator_args, compressor_args, sub_batch)
+        
+        # Failure accounting: by default give up once this process has seen ten failures
+        # per simulation it was allocated (the simulator is then most likely broken). A
+        # process that gives up stops simulating; all processes then raise together once
+        # the others have finished, so none is left waiting in the reduction below
+        kinds = ['accepted', 'exception', 'nan', 'timeout', 'retried', 'topped_up']
+        counts = dict.fromkeys(kinds, 0)
+        if max_failures is None:
+            max_failures = 10*len(self.inds_acpt)
+        gave_up = np.zeros(self.n_procs, dtype = int)
+        
+        # Run samples assigned to each process, catching exceptions, NaN/inf outputs and
+        # timeouts. A failed parameter set is retried with a fresh seed up to max_retries
+        # times before moving on to the next proposal; once this process's share of the
+        # proposals is used up, it tops up by drawing from the whole proposal set.
         i_prop = self.inds_prop[0]
         i_acpt = self.inds_acpt[0]
+        theta = ps[i_prop,:]
+        retries = 0
         err_msg = 'Simulator returns {:s} for parameter values: {} (rank {:d})'
         if self.progress_bar:
             pbar = tqdm(total = self.inds_acpt[-1], desc = "Simulations")
-        while i_acpt <= self.inds_acpt[-1]:
-            try:
-                sims = simulator(ps[i_prop,:], seed_generator(), simulator_args, sub_batch)
+        try:
+            while i_acpt <= self.inds_acpt[-1]:
+                if worker is None:
+                    try:
+                        status, compressed_sims = 'accepted', simulate_and_compress(simulator, compressor, theta, seed_generator(), simulator_args, compressor_args, sub_batch)
+                    except Exception as e:
+                        status, compressed_sims = 'exception', repr(e)
+                else:
+                    status, compressed_sims = worker.run(theta, seed_generator(), timeout)
+                if status == 'accepted' and not np.all(np.isfinite(compressed_sims.flatten())):
+                    status = 'nan'
+                counts[status] += 1
                 
-                # Make sure the sims are the right shape
-                if sub_batch == 1 and len(sims) != 1:
-                    sims = np.array([sims])
-                compressed_sims = np.array([compressor(sims[k], compressor_args) for k in range(sub_batch)])
-                if np.all(np.isfinite(compressed_sims.flatten())):
+                if status == 'accepted':
                     data_samples[i_acpt*sub_batch:i_acpt*sub_batch+sub_batch,:] = compressed_sims
-                    parameter_samples[i_acpt*sub_batch:i_acpt*sub_batch+sub_batch,:] = ps[i_prop,:]
+                    parameter_samples[i_acpt*sub_batch:i_acpt*sub_batch+sub_batch,:] = theta
                     i_acpt += 1
                     if self.progress_bar:
                         pbar.update(1)
                 else:
-                    print(err_msg.format('NaN/inf', ps[i_prop,:], self.rank))
-            except:
-                print(err_msg.format('exception', ps[i_prop,:], self.rank))
-            i_prop += 1
+                    print(err_msg.format({'exception': 'exception', 'nan': 'NaN/inf', 'timeout': 'timeout'}[status], theta, self.rank) + \
+                          (': {}'.format(compressed_sims) if status == 'exception' and compressed_sims is not None else ''))
+                    if counts['exception'] + counts['nan'] + counts['timeout'] > max_failures:
+                        gave_up[self.rank] = 1
+                        break
+                    if retries < max_retries:
+                        retries += 1
+                        counts['retried'] += 1
+                        continue
+                
+                # Next proposal (if another simulation is still needed)
+                if i_acpt > self.inds_acpt[-1]:
+                    break
+                retries = 0
+                i_prop += 1
+                if i_prop <= self.inds_prop[-1]:
+                    theta = ps[i_prop,:]
+                else:
+                    theta = ps[np.random.randint(len(ps)),:]
+                    counts['topped_up'] += 1
+        finally:
+            if worker is not None:
+                worker.close()
+
+        # Failure report, with the break-down by process
+        per_process = np.zeros((self.n_procs, len(kinds)), dtype = int)
+        per_process[self.rank,:] = [counts[kind] for kind in kinds]
+        per_process = self.complete_array(per_process)
+        self.simulation_report = dict(zip(kinds, [int(n) for n in np.sum(per_process, axis = 0)]))
+        self.simulation_report['per_process'] = per_process
+        self.simulation_report['kinds'] = kinds
+        gave_up = self.complete_array(gave_up)
+        if np.any(gave_up):
+            raise RuntimeError('More than {:d} failed simulations on rank(s) {}; giving up'.format(max_failures, [int(r) for r in np.flatnonzero(gave_up)]))
 
         # Reduce results from all processes and return
         data_samples = self.complete_array(data_samples)
         parameter_samples = self.complete_array(parameter_samples)
+        if return_report:
+            return data_samples, parameter_samples, self.simulation_report
         return data_samples, parameter_samples
 
-    # EMCEE sampler
-    def emcee_sample(self, log_likelihood=None, x0=None, burn_in_chain=100, main_chain=1000):
+    # Sample the posterior ('posterior') or the geometric-mean proposal ('proposal') for self.data
+    # with the selected sampler (self.sampler); with return_weights, returns the samples and their weights
+    def sample_density(self, density='posterior', x0=None, burn_in_chain=100, main_chain=1000, return_weights=False):
+
+        # Reuse the samples of the last chain if they survive reweighting to the current NDEs, otherwise
+        # warm-start the refresh from its walkers. The weights are always taken relative to the density the
+        # chain sampled, so the effective sample size tracks the drift accumulated since then
+        state = self.walker_states.get(density, {})
+        if self.reuse_samples and 'samples' in state:
+            start_time = time.time()
+            log_density_new, log_weights, ess = self.reweight_samples(state['samples'], state['log_density'], density)
+            self.sampling_stats.append({'sampler': 'reweight', 'n_samples': len(log_weights), 'wall_time': time.time() - start_time, \
+                                        'ess': ess, 'ess_per_sec': ess/(time.time() - start_time)})
+            if ess >= self.min_reuse_ess*len(log_weights):
+
+                # The reused samples with their importance weights, or resampled by the weights with repeated
+                # draws of a point jittered apart (simulations are run at the proposal samples)
+                if return_weights:
+                    return state['samples'], np.exp(log_weights)
+                idx = np.random.choice(len(log_weights), len(log_weights), p = np.exp(log_weights))
+                return self.jitter_resampled(state['samples'], np.exp(log_weights), idx)
+            if 'coords' in state:
+                x0, burn_in_chain = state['coords'], self.refresh_burn_in
+
+        if self.sampler == 'hmc':
+            samples = self.hmc_sample(density=density, x0=x0, burn_in_chain=burn_in_chain, main_chain=main_chain)
+        else:
+            log_prob = {'posterior': lambda x: self.log_posterior_stacked(x, self.data)[0], \
+                        'proposal': lambda x: self.log_geometric_mean_proposal_stacked(x, self.data)[0]}[density]
+
+            pool = self.log_density_pool(density)
+
+            # The proposal samples are drawn from in batches, so a proposal chain is never shorter than main_chain
+            samples = self.emcee_sample(log_likelihood=log_prob if pool is None else pool, x0=x0, burn_in_chain=burn_in_chain, main_chain=main_chain, \
+                                        target_ess=self.target_ess, max_time=self.max_sampling_time, max_chain=self.max_sampling_steps, \
+                                        min_chain=main_chain if density == 'proposal' else 0, state_key=density, vectorize=pool is not None)
+            if pool is not None:
+                self.sampling_stats[-1].update({'n_workers': pool.n_workers, 'parallel_efficiency': pool.efficiency()})
+
+        # Keep the samples and their log density under the current NDEs for reweighting next time
+        if self.reuse_samples:
+            self.walker_states.setdefault(density, {}).update({'samples': samples, 'log_density': self.log_density(samples, density)})
+        if return_weights:
+            return samples, np.ones(len(samples))*1.0/len(samples)
+        return samples
+
+    # Resampled points samples[idx] (drawn with the given weights), with every repeat of a point after the first
+    # moved by a Gaussian kernel of Silverman's bandwidth for the weighted samples, unless that leaves the parameter limits
+    def jitter_resampled(self, samples, weights, idx):
+
+        resampled = samples[idx]
+        repeats = np.ones(len(idx), dtype=bool)
+        repeats[np.unique(idx, return_index=True)[1]] = False
+        if not np.any(repeats):
+            return resampled
+        n_eff = 1./np.sum(weights**2)
+        h = (4./((self.npar + 2)*n_eff))**(1./(self.npar + 4))
+        cov = np.atleast_2d(np.cov(samples.T, aweights=weights))
+        jittered = resampled[repeats] + h*np.random.multivariate_normal(np.zeros(self.npar), cov, size=np.sum(repeats))
+        inside = np.all(jittered > self.lower, axis=1)*np.all(jittered < self.upper, axis=1)
+        resampled[np.flatnonzero(repeats)[inside]] = jittered[inside]
+        return resampled
+
+    # Update posterior_samples/posterior_weights to the current NDEs: by importance sampling from the current
+    # samples if enabled and their effective sample size suffices, otherwise by MCMC (uniform weights)
+    def update_posterior(self):
+
+        if self.importance_sampling and self.posterior_log_density is not None:
+            log_density_new, log_weights, ess = self.reweight_samples(self.posterior_samples, self.posterior_log_density, 'posterior')
+            if ess >= self.min_importance_ess*len(log_weights):
+                self.posterior_weights = np.exp(log_weights)
+                return ess
+
+        # MCMC samples (uniform weights), or reused samples with their importance weights
+        self.posterior_samples, self.posterior_weights = self.sample_density('posterior', \
+                                                   x0=[self.posterior_samples[-i,:] for i in range(self.nwalkers)], \
+                                                   main_chain=self.posterior_chain_length, return_weights=True)
+
+        # Keep the density the samples were drawn from (up to a constant), to importance weight them next time
+        if self.importance_sampling:
+            with np.errstate(divide='ignore'):
+                self.posterior_log_density = self.log_density(self.posterior_samples, 'posterior') - np.log(self.posterior_weights*len(self.posterior_weights))
+        return 1./np.sum(self.posterior_weights**2)
+
+    # Parallel walker evaluation for the emcee sampler of the given density, if enabled (and, for MPI,
+    # the other ranks are serving), loaded with the current NDEs; None otherwise. The local process
+    # pool is started once and kept alive across sampling runs until close_sampling_pool
+    def log_density_pool(self, density):
+
+        if self.parallel_sampling == 'mpi' and self.use_mpi and self.mpi_serving:
+            pool = ParallelLogDensity(comm=self.comm)
+        elif self.parallel_sampling == 'processes':
+            if self.sampling_pool is None:
+                self.sampling_pool = ParallelLogDensity(n_workers=self.n_sampling_processes)
+            pool = self.sampling_pool
+        else:
+            return None
+        pool.update(self.export_likelihood(), density, self.data)
+        return pool
+
+    def close_sampling_pool(self):
+
+        if self.sampling_pool is not None:
+            self.sampling_pool.close()
+            self.sampling_pool = None
+
+    # Non-root ranks: evaluate rank 0's batches of walkers (their share of each) until released
+    def serve_log_density(self):
+
+        while True:
+            message = self.comm.bcast(None, root=0)
+            if message[0] == 'stop':
+                return
+            if message[0] == 'update':
+                likelihood, density, data = message[1:]
+            else:
+                theta = np.array_split(np.atleast_2d(message[1]), self.n_procs)[self.rank]
+                self.comm.gather(stacked_log_density(likelihood, density, theta, data), root=0)
+
+    # In sequential_training with parallel_sampling = 'mpi', the non-root ranks serve walker evaluations
+    # from the end of each simulation batch until rank 0 has drawn the next proposal
+    def start_sampling_service(self):
+
+        if self.use_mpi and self.parallel_sampling == 'mpi':
+            if self.rank == 0:
+                self.mpi_serving = True
+            else:
+                self.serve_log_density()
+
+    def stop_sampling_service(self):
+
+        if self.mpi_serving:
+            self.comm.bcast(('stop',), root=0)
+            self.mpi_serving = False
+
+    # Log posterior ('posterior') or geometric-mean proposal ('proposal') density for self.data at many
+    # parameter sets at once; theta has shape (n, npar), returns shape (n,)
+    def log_density(self, theta, density='posterior'):
+
+        lnL = self.log_likelihood_stacked(theta, self.data)[:,0]
+        if density == 'proposal':
+            lnL = 0.5*lnL
+        return lnL + self.prior.logpdf(theta)
+
+    # Importance weights that take samples drawn from a density with log values log_density_old (e.g. under
+    # the previous NDEs) to the current density: returns the current log density, the normalized log weights
+    # and the (Kish) effective sample size of the weights
+    def reweight_samples(self, samples, log_density_old, density='posterior'):
+
+        log_density = self.log_density(samples, density)
+        log_weights = np.nan_to_num(log_density - log_density_old, nan = -np.inf)
+        log_weights = log_weights - logsumexp(log_weights)
+        ess = 1./np.sum(np.exp(2*log_weights))
+        return log_density, log_weights, ess
+
+    # EMCEE sampler: a fixed burn_in_chain + main_chain steps, or, if target_ess is given, run until
+    # the chain holds target_ess effective samples (see emcee_sample_to_target)
+    def emcee_sample(self, log_likelihood=None, x0=None, burn_in_chain=100, main_chain=1000, \
+                     target_ess=None, max_time=None, min_chain=0, state_key=None, vectorize=False, max_chain=None):
     
         # Set the log likelihood (default to the posterior if none given)
         if log_likelihood is None:
@@ -342,21 +793,198 @@ class Delfi():
             x0 = [self.posterior_samples[-i,:] for i in range(self.nwalkers)]
         
         # Set up the sampler
-        sampler = emcee.EnsembleSampler(self.nwalkers, self.npar, log_likelihood)
+        sampler = emcee.EnsembleSampler(self.nwalkers, self.npar, log_likelihood, vectorize=vectorize)
+        start_time = time.time()
+
+        if target_ess is None:
     
-        # Burn-in chain
-        state = sampler.run_mcmc(x0, burn_in_chain)
-        sampler.reset()
+            # Burn-in chain
+            state = sampler.run_mcmc(x0, burn_in_chain)
+            sampler.reset()
     
-        # Main chain
-        sampler.run_mcmc(state.coords, main_chain)
+            # Main chain
+            sampler.run_mcmc(state.coords, main_chain)
+            chain = sampler.get_chain()
+        else:
+
+            # Warm start from the walkers of the previous run for this density. If the density is unchanged
+            # (same log density at the walkers), that run's chain is continued rather than started over
+            previous = self.walker_states.get(state_key, {})
+            previous_chain = None
+            if 'coords' in previous:
+                x0 = previous['coords']
+                log_prob = np.ravel(log_likelihood(x0) if vectorize else [log_likelihood(x) for x in x0])
+                if previous.get('chain') is not None and np.allclose(log_prob, previous['log_prob']):
+                    previous_chain = previous['chain']
+            chain, tau = self.emcee_sample_to_target(sampler, x0, target_ess, max_time, min_chain, \
+                                                     tau_guess=previous.get('tau'), max_chain=max_chain, \
+                                                     previous_chain=previous_chain)
+        if state_key is not None:
+            last_sample = sampler.get_last_sample()
+            self.walker_states[state_key] = {'coords': last_sample.coords, 'log_prob': last_sample.log_prob, \
+                                             'tau': tau if target_ess is not None else None, \
+                                             'chain': chain if target_ess is not None else None}
+        self.record_sampling_stats('emcee', chain, time.time() - start_time)
     
-        return sampler.flatchain
+        return chain.reshape(-1, self.npar)
+
+    # Run an emcee sampler from x0, checking the integrated autocorrelation time tau every ~tau steps, until
+    # the tau estimate is reliable (the chain is tau_tol*tau long and tau has settled to within 5%) and the
+    # chain, after discarding 2*tau steps of burn-in, holds target_ess effective samples and at least min_chain
+    # steps; or until max_time seconds or max_chain steps (of this run) have been spent, with a warning if the
+    # target was not reached. A warm start (tau_guess from the previous run, walkers already in equilibrium)
+    # only needs a chain of tau_tol/5 autocorrelation times. The chain of the previous run of the same density
+    # (previous_chain, ending at x0) is continued: it counts towards the target and no burn-in is discarded.
+    # Returns the post burn-in chain (steps, walkers, npar) and the final tau
+    def emcee_sample_to_target(self, sampler, x0, target_ess, max_time=None, min_chain=0, tau_guess=None, \
+                               max_chain=None, tau_tol=50, previous_chain=None):
+
+        start_time = time.time()
+        tau = tau_guess if tau_guess is not None else 10.
+        if tau_guess is not None:
+            tau_tol = tau_tol/5.
+        state = x0
+        while True:
+
+            # Run for (roughly) another autocorrelation time
+            state = sampler.run_mcmc(state, max(int(tau), 10))
+            chain = sampler.get_chain() if previous_chain is None else np.concatenate([previous_chain, sampler.get_chain()])
+            n_steps = len(chain)
+            tau_new = np.max(emcee.autocorr.integrated_time(chain, tol = 0, quiet = True))
+            reliable = n_steps > tau_tol*tau_new and abs(tau_new - tau) < 0.05*tau_new
+            tau = tau_new
+
+            # Effective samples after burn-in
+            burn_in = min(int(2*tau), n_steps - 1) if previous_chain is None else 0
+            ess = self.nwalkers*(n_steps - burn_in)/tau
+            if reliable and ess >= target_ess and n_steps - burn_in >= min_chain:
+
+                # Keep only as much of a continued chain as the target needs
+                if previous_chain is not None:
+                    burn_in = max(n_steps - max(int(np.ceil(target_ess*tau/self.nwalkers)), min_chain), 0)
+                break
+            if (max_time is not None and time.time() - start_time > max_time) or \
+               (max_chain is not None and sampler.iteration >= max_chain):
+                warnings.warn('Stopped sampling after {:d} steps with {:.0f}/{:d} effective samples{}'.format(sampler.iteration, ess, int(target_ess), \
+                              '' if reliable else ' (autocorrelation time not converged)'), RuntimeWarning)
+                break
+
+        return chain[burn_in:], tau
+
+    # Record the effective number of samples (for the worst-mixing parameter) per second of a sampling run,
+    # from a chain of shape (steps, walkers/chains, npar)
+    def record_sampling_stats(self, sampler, chain, wall_time):
+
+        ess = effective_sample_size(chain)
+        self.sampling_stats.append({'sampler': sampler, 'n_samples': chain.shape[0]*chain.shape[1], 'wall_time': wall_time, \
+                                    'ess': float(np.min(ess)), 'ess_per_sec': float(np.min(ess))/wall_time})
+
+    # Individual NDE log likelihoods, shape (n, n_ndes), and their gradients with respect to theta,
+    # shape (n_ndes, n, npar), from the NDEs' tensorflow gradients; all NDEs are evaluated in a single sess.run
+    def log_likelihood_gradient_individual(self, theta, data):
+
+        x = np.atleast_2d((theta - self.p_mean)/self.p_std)
+        y = np.repeat(np.atleast_2d((data - self.x_mean)/self.x_std), len(x), axis=0)
+        fetches = []
+        feed_dict = {}
+        for nde in self.nde:
+            L = nde.L
+            if L.name not in self.nde_gradients:
+                self.nde_gradients[L.name] = tf.gradients(L, nde.parameters)[0]
+            fetches.append([L, self.nde_gradients[L.name]])
+            feed_dict.update({nde.parameters: x, nde.data: y})
+        results = self.sess.run(fetches, feed_dict=feed_dict)
+        return np.concatenate([r[0] for r in results], axis=1), np.array([r[1] for r in results])/self.p_std
+
+    # Stacked log likelihood and its gradient with respect to theta (rows of theta are independent)
+    def log_likelihood_gradient_stacked(self, theta, data):
+
+        # Stacked with weights w_n: grad log sum_n w_n exp(L_n) = sum_n softmax(L_n + log w_n) grad L_n
+        L, grads = self.log_likelihood_gradient_individual(theta, data)
+        L = L + np.log(self.stacking_weights)
+        lnL = logsumexp(L, axis=1)
+        responsibilities = np.exp(L - lnL[:,np.newaxis])
+        grad = np.einsum('in,nij->ij', responsibilities, grads)
+        bad = ~np.isfinite(lnL)
+        lnL[bad] = -1e300
+        grad[bad] = 0
+        return lnL, grad
+
+    # Log density ('posterior' or 'proposal') and its gradient for rows of theta
+    def log_density_gradient(self, theta, density='posterior'):
+
+        if not hasattr(self.prior, 'logpdf_gradient'):
+            raise ValueError('HMC sampling needs a prior with a logpdf_gradient method')
+        lnL, grad = self.log_likelihood_gradient_stacked(theta, self.data)
+        if density == 'proposal':
+            lnL, grad = 0.5*lnL, 0.5*grad
+        return lnL + self.prior.logpdf(theta), grad + self.prior.logpdf_gradient(theta)
+
+    # Hamiltonian Monte Carlo: n_chains chains (default nwalkers) advanced together, so that each leapfrog
+    # step is one batched evaluation of the log density gradient. The step size is tuned during burn-in
+    # by dual averaging to a target acceptance rate, and the mass matrix is diagonal, scaled to the spread
+    # of x0. Returns main_chain*n_chains samples, ordered as emcee's flatchain
+    def hmc_sample(self, density='posterior', x0=None, burn_in_chain=100, main_chain=1000, n_chains=None, \
+                   n_leapfrog=10, step_size=None, target_accept=0.65):
+
+        # Set up default x0
+        if n_chains is None:
+            n_chains = self.nwalkers if x0 is None else len(x0)
+        if x0 is None:
+            x0 = [self.posterior_samples[-i,:] for i in range(n_chains)]
+        theta = np.array(x0, dtype = np.float64)
+        scale = np.std(theta, axis = 0)
+        if not np.all(scale > 0):
+            scale = np.ones(self.npar)
+        log_density, grad = self.log_density_gradient(theta, density)
+
+        # Dual averaging of the (log) step size, in units of the scale [Hoffman & Gelman 2014]
+        log_eps = np.log(step_size if step_size is not None else 1./self.npar**0.25)
+        mu, log_eps_bar, h_bar = np.log(10.) + log_eps, 0., 0.
+
+        start_time = time.time()
+        chain = np.zeros((main_chain, n_chains, self.npar))
+        for step in range(burn_in_chain + main_chain):
+
+            # Leapfrog integration (in the scaled coordinates theta/scale), with a jittered step size
+            eps = np.exp(log_eps)*np.random.uniform(0.8, 1.2)
+            p = np.random.normal(0, 1, (n_chains, self.npar))
+            H0 = log_density - 0.5*np.sum(p**2, axis = 1)
+            theta_new, log_density_new, grad_new = theta, log_density, grad
+            p_new = p + 0.5*eps*grad_new*scale
+            for l in range(n_leapfrog):
+                theta_new = theta_new + eps*p_new*scale
+                log_density_new, grad_new = self.log_density_gradient(theta_new, density)
+                p_new = p_new + (eps if l < n_leapfrog - 1 else 0.5*eps)*grad_new*scale
+            H1 = log_density_new - 0.5*np.sum(p_new**2, axis = 1)
+
+            # Metropolis correction
+            log_accept = np.minimum(np.nan_to_num(H1 - H0, nan = -np.inf), 0.)
+            accept = np.log(np.random.uniform(0, 1, n_chains)) < log_accept
+            theta = np.where(accept[:,np.newaxis], theta_new, theta)
+            log_density = np.where(accept, log_density_new, log_density)
+            grad = np.where(accept[:,np.newaxis], grad_new, grad)
+
+            # Adapt the step size during burn-in, then fix it
+            if step < burn_in_chain:
+                m = step + 1
+                h_bar = (1 - 1./(m + 10))*h_bar + (target_accept - np.mean(np.exp(log_accept)))/(m + 10)
+                log_eps = mu - np.sqrt(m)/0.05*h_bar
+                log_eps_bar = m**-0.75*log_eps + (1 - m**-0.75)*log_eps_bar
+                if step == burn_in_chain - 1:
+                    log_eps = log_eps_bar
+            else:
+                chain[step - burn_in_chain] = theta
+        self.record_sampling_stats('hmc', chain, time.time() - start_time)
+
+        return chain.reshape(-1, self.npar)
 
     def sequential_training(self, simulator, compressor, n_initial, n_batch, n_populations, proposal = None, \
                             simulator_args = None, compressor_args = None, safety = 5, plot = True, batch_size = 100, \
                             validation_split = 0.1, epochs = 300, patience = 20, seed_generator = None, \
-                            save_intermediate_posteriors = True, sub_batch = 1):
+                            save_intermediate_posteriors = True, sub_batch = 1, simulation_timeout = None, max_retries = 0, \
+                            incremental = False, incremental_fraction = 0.25, incremental_epochs = 50, incremental_patience = 5, \
+                            incremental_time = None, new_sample_weight = 3., adaptive_batch_size = False):
 
         # Set up the initial parameter proposal density
         if proposal is None:
@@ -374,7 +1002,7 @@ class Delfi():
         # proposal array (self.inds_prop) and accepted arrays
         # (self.inds_acpt) to allow for easy MPI communication.
         if self.rank == 0:
-            ps = np.array([proposal.draw() for i in range(safety * n_initial)])
+            ps = draw_samples(proposal, safety * n_initial)
         else:
             ps = np.zeros((safety * n_initial, self.npar))
         if self.use_mpi:
@@ -383,7 +1011,9 @@ class Delfi():
         self.inds_acpt = self.allocate_jobs(n_initial)
 
         # Run simulations at those theta values
-        xs_batch, ps_batch = self.run_simulation_batch(n_initial, ps, simulator, compressor, simulator_args, compressor_args, seed_generator = seed_generator, sub_batch = sub_batch)
+        xs_batch, ps_batch = self.run_simulation_batch(n_initial, ps, simulator, compressor, simulator_args, compressor_args, seed_generator = seed_generator, sub_batch = sub_batch, \
+                                                           timeout = simulation_timeout, max_retries = max_retries)
+        self.start_sampling_service()
 
         # Train on master only
         if self.rank == 0:
@@ -392,7 +1022,7 @@ class Delfi():
             self.load_simulations(xs_batch, ps_batch)
 
             # Train the network on these initial simulations
-            self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=max(self.n_sims//8, batch_size), validation_split=validation_split, epochs=epochs, patience=patience)
+            self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=batch_size if adaptive_batch_size else max(self.n_sims//8, batch_size), validation_split=validation_split, epochs=epochs, patience=patience, adaptive_batch_size=adaptive_batch_size)
             self.stacked_sequential_training_loss.append(np.sum(np.array([self.training_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
             self.stacked_sequential_validation_loss.append(np.sum(np.array([self.validation_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
             self.sequential_nsims.append(self.n_sims)
@@ -400,20 +1030,20 @@ class Delfi():
             # Generate posterior samples
             if save_intermediate_posteriors:
                 print('Sampling approximate posterior...')
-                self.posterior_samples = self.emcee_sample(log_likelihood = lambda x: self.log_posterior_stacked(x, self.data)[0],
-                                                           x0=[self.posterior_samples[-i,:] for i in range(self.nwalkers)], \
-                                                           main_chain=self.posterior_chain_length)
+                self.update_posterior()
             
                 # Save posterior samples to file
                 f = open('{}posterior_samples_0.dat'.format(self.results_dir), 'w')
                 np.savetxt(f, self.posterior_samples)
                 f.close()
+                if self.importance_sampling or self.reuse_samples:
+                    np.savetxt('{}posterior_weights_0.dat'.format(self.results_dir), self.posterior_weights)
             
                 print('Done.')
 
                 # If plot == True, plot the current posterior estimate
                 if plot == True:
-                    self.triangle_plot([self.posterior_samples], \
+                    self.triangle_plot([self.posterior_samples], weights=[self.posterior_weights], \
                                     savefig=True, \
                                     filename='{}seq_train_post_0.pdf'.format(self.results_dir))
     
@@ -435,7 +1065,7 @@ class Delfi():
                 # Sample the current posterior approximation
                 print('Sampling proposal density...')
                 self.proposal_samples = \
-                    self.emcee_sample(log_likelihood = lambda x: self.log_geometric_mean_proposal_stacked(x, self.data)[0], \
+                    self.sample_density('proposal', \
                                       x0=[self.proposal_samples[-j,:] for j in range(self.nwalkers)], \
                                       main_chain=self.proposal_chain_length)
                 ps_batch = self.proposal_samples[-safety * n_batch:,:]
@@ -443,13 +1073,16 @@ class Delfi():
 
             else:
                 ps_batch = np.zeros((safety * n_batch, self.npar))
+            self.stop_sampling_service()
             if self.use_mpi:
                 self.comm.Bcast(ps_batch, root=0)
 
             # Run simulations
             self.inds_prop = self.allocate_jobs(safety * n_batch)
             self.inds_acpt = self.allocate_jobs(n_batch)
-            xs_batch, ps_batch = self.run_simulation_batch(n_batch, ps_batch, simulator, compressor, simulator_args, compressor_args, seed_generator = seed_generator, sub_batch = sub_batch)
+            xs_batch, ps_batch = self.run_simulation_batch(n_batch, ps_batch, simulator, compressor, simulator_args, compressor_args, seed_generator = seed_generator, sub_batch = sub_batch, \
+                                                           timeout = simulation_timeout, max_retries = max_retries)
+            self.start_sampling_service()
 
             # Train on master only
             if self.rank == 0:
@@ -457,8 +1090,16 @@ class Delfi():
                 # Augment the training data
                 self.add_simulations(xs_batch, ps_batch)
         
-                # Train the network on these initial simulations
-                self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=max(self.n_sims//8, batch_size), validation_split=0.1, epochs=epochs, patience=patience)
+                # Train the network on the augmented training set. In incremental mode, once the new
+                # simulations are only a small fraction of the data, continue from the current weights
+                # with a short epoch/wall-clock budget and up-weight the new samples
+                if incremental and len(ps_batch) <= incremental_fraction*self.n_sims:
+                    sample_weights = np.ones(self.n_sims)
+                    sample_weights[-len(ps_batch):] = new_sample_weight
+                    self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=batch_size if adaptive_batch_size else max(self.n_sims//8, batch_size), validation_split=0.1, epochs=incremental_epochs, patience=incremental_patience, \
+                                    warm_start=True, sample_weights=sample_weights, max_time=incremental_time, adaptive_batch_size=adaptive_batch_size)
+                else:
+                    self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=batch_size if adaptive_batch_size else max(self.n_sims//8, batch_size), validation_split=0.1, epochs=epochs, patience=patience, adaptive_batch_size=adaptive_batch_size)
                 self.stacked_sequential_training_loss.append(np.sum(np.array([self.training_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
                 self.stacked_sequential_validation_loss.append(np.sum(np.array([self.validation_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
                 self.sequential_nsims.append(self.n_sims)
@@ -466,21 +1107,21 @@ class Delfi():
                 # Generate posterior samples
                 if save_intermediate_posteriors:
                     print('Sampling approximate posterior...')
-                    self.posterior_samples = self.emcee_sample(log_likelihood = lambda x: self.log_posterior_stacked(x, self.data)[0],
-                                                           x0=[self.posterior_samples[-i,:] for i in range(self.nwalkers)], \
-                                                           main_chain=self.posterior_chain_length)
+                    self.update_posterior()
                 
                     # Save posterior samples to file
                     f = open('{}posterior_samples_{:d}.dat'.format(self.results_dir, i+1), 'w')
                     np.savetxt(f, self.posterior_samples)
                     f.close()
+                    if self.importance_sampling or self.reuse_samples:
+                        np.savetxt('{}posterior_weights_{:d}.dat'.format(self.results_dir, i+1), self.posterior_weights)
 
                     print('Done.')
 
                     # If plot == True
                     if plot == True:
                         # Plot the posterior
-                        self.triangle_plot([self.posterior_samples], \
+                        self.triangle_plot([self.posterior_samples], weights=[self.posterior_weights], \
                                         savefig=True, \
                                         filename='{}seq_train_post_{:d}.pdf'.format(self.results_dir, i + 1))
 
@@ -489,7 +1130,191 @@ class Delfi():
                     # Plot the training loss convergence
                     self.sequential_training_plot(savefig=True, filename='{}seq_train_loss.pdf'.format(self.results_dir))
 
-    def train_ndes(self, training_data=None, batch_size=100, validation_split=0.1, epochs=500, patience=20, mode='samples'):
+        # Release the ranks serving walker evaluations and the sampling processes
+        self.stop_sampling_service()
+        self.close_sampling_pool()
+
+    def pipelined_sequential_training(self, simulator, compressor, n_initial, n_batch, n_populations, proposal = None, \
+                                      simulator_args = None, compressor_args = None, safety = 5, plot = True, batch_size = 100, \
+                                      validation_split = 0.1, epochs = 300, patience = 20, seed_generator = None, \
+                                      save_intermediate_posteriors = True, sub_batch = 1, executor = None, n_workers = 4, max_staleness = 1):
+        
+        # Asynchronous version of sequential_training: simulator calls run on an executor
+        # (a thread pool with n_workers threads by default, or any concurrent.futures
+        # executor passed in), and the simulations for the next max_staleness populations
+        # are proposed from the current NDEs and start running while the NDEs train.
+        # max_staleness = 0 recovers the strictly phased behaviour of sequential_training.
+        # Single process only: with MPI use sequential_training.
+        if self.use_mpi:
+            raise ValueError('pipelined_sequential_training runs on a single process; use sequential_training with MPI')
+        
+        # Random seed generator: set to unsigned 32 bit int random numbers as default
+        if seed_generator is None:
+            seed_generator = lambda: np.random.randint(2147483647)
+        
+        # Set up the initial parameter proposal density
+        if proposal is None:
+            if self.Finv is not None:
+                proposal = priors.TruncatedGaussian(self.theta_fiducial, 9*self.Finv, self.lower, self.upper)
+            else:
+                proposal = self.prior
+        
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = n_workers)
+        
+        # Populations in flight, oldest first. Each holds its pool of proposed parameters
+        # (over-proposed by a factor of safety), the running simulator calls, and the
+        # accepted simulations not yet added to the training set
+        in_flight = collections.deque()
+        
+        # Simulator calls still running when their population completed. Future.cancel()
+        # cannot stop a call that has started, so rather than abandon them (keeping an
+        # executor worker busy for nothing) their results go into later training sets
+        leftover = {'ps': np.zeros((0, self.npar)), 'next': 0, 'n_needed': 0, 'futures': {}, 'xs': [], 'ps_acpt': []}
+        err_msg = 'Simulator returns {:s} for parameter values: {}'
+        
+        def submit(population):
+            theta = population['ps'][population['next'],:]
+            population['next'] += 1
+            future = executor.submit(simulate_and_compress, simulator, compressor, theta, seed_generator(), simulator_args, compressor_args, sub_batch)
+            population['futures'][future] = theta
+        
+        def launch(ps, n):
+            population = {'ps': ps, 'next': 0, 'n_needed': n, 'futures': {}, 'xs': [], 'ps_acpt': []}
+            for j in range(min(n, len(ps))):
+                submit(population)
+            in_flight.append(population)
+        
+        def collect(population, block):
+            # Gather finished simulator calls, replacing failures from the proposal pool
+            if block:
+                concurrent.futures.wait(list(population['futures']), return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in [f for f in population['futures'] if f.done()]:
+                theta = population['futures'].pop(future)
+                try:
+                    compressed_sims = future.result()
+                    accept = np.all(np.isfinite(compressed_sims.flatten()))
+                    if not accept:
+                        print(err_msg.format('NaN/inf', theta))
+                except Exception:
+                    accept = False
+                    print(err_msg.format('exception', theta))
+                if accept:
+                    population['xs'].append(compressed_sims)
+                    population['ps_acpt'].append(np.tile(theta, (len(compressed_sims), 1)))
+                    population['n_needed'] = max(population['n_needed'] - 1, 0)
+                elif not accept and population['next'] < len(population['ps']):
+                    submit(population)
+        
+        def propose(n):
+            # Sample the current approximation to the proposal density
+            print('Sampling proposal density...')
+            self.proposal_samples = \
+                self.sample_density('proposal', \
+                                  x0=[self.proposal_samples[-j,:] for j in range(self.nwalkers)], \
+                                  main_chain=self.proposal_chain_length)
+            print('Done.')
+            return self.proposal_samples[-safety * n:,:]
+        
+        try:
+            # Initial population from the broad proposal
+            launch(draw_samples(proposal, safety * n_initial), n_initial)
+            n_launched = 1
+            
+            for i in range(n_populations + 1):
+                
+                if i > 0:
+                    print('Population {}/{}'.format(i, n_populations))
+                
+                # Wait for the oldest population to complete
+                population = in_flight[0]
+                if self.progress_bar:
+                    pbar = tqdm(total = population['n_needed'], desc = "Simulations")
+                while population['n_needed'] > 0:
+                    if len(population['futures']) == 0:
+                        raise RuntimeError('ran out of proposed parameters: too many failed simulations, try increasing safety')
+                    n_needed = population['n_needed']
+                    collect(population, block = True)
+                    if self.progress_bar:
+                        pbar.update(n_needed - population['n_needed'])
+                if self.progress_bar:
+                    pbar.close()
+                in_flight.popleft()
+                leftover['futures'].update(population['futures'])
+                
+                # Stream in everything that has completed so far, including finished
+                # simulations from populations still in flight and leftover calls
+                for later in [leftover] + list(in_flight):
+                    collect(later, block = False)
+                xs_batch = np.concatenate([np.concatenate(p['xs']) for p in [population, leftover] + list(in_flight) if len(p['xs']) > 0])
+                ps_batch = np.concatenate([np.concatenate(p['ps_acpt']) for p in [population, leftover] + list(in_flight) if len(p['ps_acpt']) > 0])
+                for p in [leftover] + list(in_flight):
+                    p['xs'], p['ps_acpt'] = [], []
+                
+                # Propose ahead from the current NDEs, so these simulations run during training
+                if i > 0:
+                    while len(in_flight) < max_staleness and n_launched < n_populations + 1:
+                        launch(propose(n_batch), n_batch)
+                        n_launched += 1
+                
+                # Augment the training data and re-train
+                if i == 0:
+                    self.load_simulations(xs_batch, ps_batch)
+                else:
+                    self.add_simulations(xs_batch, ps_batch)
+                self.train_ndes(training_data=[self.x_train, self.y_train], batch_size=max(self.n_sims//8, batch_size), validation_split=validation_split, epochs=epochs, patience=patience)
+                self.stacked_sequential_training_loss.append(np.sum(np.array([self.training_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
+                self.stacked_sequential_validation_loss.append(np.sum(np.array([self.validation_loss[n][-1]*self.stacking_weights[n] for n in range(self.n_ndes)])))
+                self.sequential_nsims.append(self.n_sims)
+                
+                # Make sure the next population is under way
+                if len(in_flight) == 0 and n_launched < n_populations + 1:
+                    launch(propose(n_batch), n_batch)
+                    n_launched += 1
+                
+                # Generate posterior samples
+                if save_intermediate_posteriors:
+                    print('Sampling approximate posterior...')
+                    self.update_posterior()
+                    
+                    # Save posterior samples to file
+                    f = open('{}posterior_samples_{:d}.dat'.format(self.results_dir, i), 'w')
+                    np.savetxt(f, self.posterior_samples)
+                    f.close()
+                    if self.importance_sampling or self.reuse_samples:
+                        np.savetxt('{}posterior_weights_{:d}.dat'.format(self.results_dir, i), self.posterior_weights)
+                    
+                    print('Done.')
+                    
+                    # If plot == True, plot the current posterior estimate
+                    if plot == True:
+                        self.triangle_plot([self.posterior_samples], weights=[self.posterior_weights], \
+                                           savefig=True, \
+                                           filename='{}seq_train_post_{:d}.pdf'.format(self.results_dir, i))
+                
+                # Plot training convergence
+                if plot == True and i > 0:
+                    self.sequential_training_plot(savefig=True, filename='{}seq_train_loss.pdf'.format(self.results_dir))
+                
+                # Save attributes if save == True
+                if self.save == True:
+                    self.saver()
+        
+        finally:
+            # Cancel anything still queued and release our own workers. Simulator calls
+            # already running cannot be interrupted: they finish in the background and
+            # their results are discarded
+            for population in [leftover] + list(in_flight):
+                for future in population['futures']:
+                    future.cancel()
+            if own_executor:
+                executor.shutdown(wait = False)
+            self.close_sampling_pool()
+
+    def train_ndes(self, training_data=None, batch_size=100, validation_split=0.1, epochs=500, patience=20, mode='samples', \
+                   warm_start=False, sample_weights=None, max_time=None, adaptive_batch_size=False, max_batch_size=None, \
+                   train_data_generator=None, regenerate_every=1):
     
         # Set the default training data if none
         if training_data is None:
@@ -498,7 +1323,10 @@ class Delfi():
         # Train the networks
         for n in range(self.n_ndes):
             # Train the NDE
-            val_loss, train_loss = self.trainer[n].train(self.sess, training_data, validation_split = validation_split, epochs=epochs, batch_size=batch_size, progress_bar=self.progress_bar, patience=patience, saver_name=self.graph_restore_filename, mode=mode)
+            val_loss, train_loss = self.trainer[n].train(self.sess, training_data, validation_split = validation_split, epochs=epochs, batch_size=batch_size, progress_bar=self.progress_bar, patience=patience, saver_name=self.graph_restore_filename, mode=mode, \
+                                                         warm_start=warm_start, sample_weights=sample_weights, max_time=max_time, \
+                                                         adaptive_batch_size=adaptive_batch_size, max_batch_size=max_batch_size, \
+                                                         train_data_generator=train_data_generator, regenerate_every=regenerate_every)
         
             # Save the training and validation losses
             self.training_loss[n] = np.concatenate([self.training_loss[n], train_loss])
@@ -523,82 +1351,98 @@ class Delfi():
 
         ps_batch = (ps_batch - self.p_mean)/self.p_std
         xs_batch = (xs_batch - self.x_mean)/self.x_std
-        self.ps = np.concatenate([self.ps, ps_batch])
-        self.xs = np.concatenate([self.xs, xs_batch])
-        self.x_train = self.ps.astype(np.float32)
-        self.y_train = self.xs.astype(np.float32)
-        self.n_sims += len(ps_batch)
+        self.append_simulations(xs_batch, ps_batch)
     
     def add_simulations(self, xs_batch, ps_batch):
         
         ps_batch = (ps_batch - self.p_mean)/self.p_std
         xs_batch = (xs_batch - self.x_mean)/self.x_std
-        self.ps = np.concatenate([self.ps, ps_batch])
-        self.xs = np.concatenate([self.xs, xs_batch])
-        self.x_train = self.ps.astype(np.float32)
-        self.y_train = self.xs.astype(np.float32)
-        self.n_sims += len(ps_batch)
+        self.append_simulations(xs_batch, ps_batch)
+
+    # Append (normalized) simulations to the training set. Buffers are doubled when full, so
+    # earlier rows are not copied at every population; the trainers' persistent train/validation
+    # splits index into the same rows, so only the new rows get assigned
+    def append_simulations(self, xs_batch, ps_batch):
+
+        n_sims = self.n_sims + len(ps_batch)
+        if n_sims > len(self.training_buffers[0]):
+            size = max(n_sims, 2*len(self.training_buffers[0]))
+            buffers = [np.zeros((size,) + buffer.shape[1:], dtype=buffer.dtype) for buffer in self.training_buffers]
+            for buffer, old_buffer in zip(buffers, self.training_buffers):
+                buffer[:self.n_sims] = old_buffer[:self.n_sims]
+            self.training_buffers = buffers
+        for buffer, batch in zip(self.training_buffers, [ps_batch, xs_batch, ps_batch, xs_batch]):
+            buffer[self.n_sims:n_sims] = batch
+        self.ps, self.xs, self.x_train, self.y_train = [buffer[:n_sims] for buffer in self.training_buffers]
+        self.n_sims = n_sims
     
-    def fisher_pretraining(self, n_batch=5000, plot=True, batch_size=100, validation_split=0.1, epochs=1000, patience=20, mode='regression'):
+    # Fisher pre-training data: n_batch draws each from the prior, the asymptotic posterior and a broader
+    # proposal (re-scaled to the Fisher errors about the fiducial point), data from the anticipated Gaussian
+    # likelihood, and its log density at those data
+    def fisher_pretraining_data(self, n_batch):
+
+        # Broader proposal
+        proposal = priors.TruncatedGaussian(self.theta_fiducial, 9*self.Finv, self.lower, self.upper)
+
+        # Anticipated covariance of the re-scaled data
+        Cdd = self.Finv/np.outer(self.fisher_errors, self.fisher_errors)
+        Ldd = np.linalg.cholesky(Cdd)
+        Cddinv = np.linalg.inv(Cdd)
+        ln2pidetCdd = np.log(2*np.pi*np.linalg.det(Cdd))
+
+        # Sample parameters from the prior, the asymptotic posterior and the Gaussian with 3x the anticipated covariance
+        ps = (np.concatenate([draw_samples(self.prior, n_batch), \
+                              draw_samples(self.asymptotic_posterior, n_batch), \
+                              draw_samples(proposal, n_batch)]) - self.theta_fiducial)/self.fisher_errors
+
+        # Sample data assuming a Gaussian likelihood, and evaluate the logpdf at those values
+        xs = ps + np.dot(np.random.normal(0, 1, ps.shape), Ldd.T)
+        fisher_logpdf_train = -0.5*np.einsum('ij,jk,ik->i', xs - ps, Cddinv, xs - ps) - 0.5*ln2pidetCdd
+
+        return ps.astype(np.float32), xs.astype(np.float32), fisher_logpdf_train.astype(np.float32).reshape(-1,1)
+
+    # Pre-train the NDEs on data from the Fisher-matrix Gaussian likelihood. With stream = True the pre-training
+    # set is streamed: a fixed validation set of validation_split*3*n_batch points is generated once, and
+    # training draws a fresh set of 3*n_batch points every regenerate_every epochs, so only one set is ever
+    # held in memory and early stopping runs on the single validation set
+    def fisher_pretraining(self, n_batch=5000, plot=True, batch_size=100, validation_split=0.1, epochs=1000, patience=20, mode='regression', \
+                           stream=False, regenerate_every=1):
 
         # Train on master only
         if self.rank == 0:
 
             # Generate fisher pre-training data
-            
-            # Broader proposal
-            proposal = priors.TruncatedGaussian(self.theta_fiducial, 9*self.Finv, self.lower, self.upper)
-
-            # Anticipated covariance of the re-scaled data
-            Cdd = np.zeros((self.npar, self.npar))
-            for i in range(self.npar):
-                for j in range(self.npar):
-                    Cdd[i,j] = self.Finv[i,j]/(self.fisher_errors[i]*self.fisher_errors[j])
-            Ldd = np.linalg.cholesky(Cdd)
-            Cddinv = np.linalg.inv(Cdd)
-            ln2pidetCdd = np.log(2*np.pi*np.linalg.det(Cdd))
-            
-            # Sample parameters from some broad proposal
-            ps = np.zeros((3*n_batch, self.npar))
-            for i in range(0, n_batch):
-                # Draws from prior
-                ps[i,:] = (self.prior.draw() - self.theta_fiducial)/self.fisher_errors
-                
-                # Draws from asymptotic posterior
-                ps[n_batch + i,:] = (self.asymptotic_posterior.draw() - self.theta_fiducial)/self.fisher_errors
-                
-                # Drawn from Gaussian with 3x anticipated covariance matrix
-                ps[2*n_batch + i,:] = (proposal.draw() - self.theta_fiducial)/self.fisher_errors
-            
-            # Sample data assuming a Gaussian likelihood
-            xs = np.array([pss + np.dot(Ldd, np.random.normal(0, 1, self.npar)) for pss in ps])
-            
-            # Evaluate the logpdf at those values
-            fisher_logpdf_train = np.array([-0.5*np.dot(xs[i,:]-ps[i,:], np.dot(Cddinv, xs[i,:]-ps[i,:])) - 0.5*ln2pidetCdd for i in range(len(xs))])
-            
-            # Construct the initial training-set
-            fisher_x_train = ps.astype(np.float32).reshape((3*n_batch, self.npar))
-            fisher_y_train = xs.astype(np.float32).reshape((3*n_batch, self.npar))
-            
-            # Train the networks depending on the chosen mode (regression = default)
-            
+            if stream:
+                fisher_data = lambda: self.fisher_pretraining_data(n_batch)
+                fisher_x_train, fisher_y_train, fisher_logpdf_train = self.fisher_pretraining_data(max(int(validation_split*n_batch), 1))
+            else:
+                fisher_data = None
+                fisher_x_train, fisher_y_train, fisher_logpdf_train = self.fisher_pretraining_data(n_batch)
+
+            # Train the networks depending on the chosen mode (regression = default), on their
+            # own train/validation split (forgotten again afterwards, for the simulations)
+            for trainer in self.trainer:
+                trainer.reset_split()
+
             if mode == "regression":
                 # Train the networks on these initial simulations
-                self.train_ndes(training_data=[fisher_x_train, fisher_y_train, np.atleast_2d(fisher_logpdf_train).reshape(-1,1)], validation_split = validation_split, epochs=epochs, batch_size=batch_size, patience=patience, mode='regression')
+                self.train_ndes(training_data=[fisher_x_train, fisher_y_train, fisher_logpdf_train], validation_split = validation_split, epochs=epochs, batch_size=batch_size, patience=patience, mode='regression', \
+                                train_data_generator=fisher_data, regenerate_every=regenerate_every)
             if mode == "samples":
                 # Train the networks on these initial simulations
-                self.train_ndes(training_data=[fisher_x_train, fisher_y_train], validation_split = validation_split, epochs=epochs, batch_size=batch_size, patience=patience, mode='samples')
+                self.train_ndes(training_data=[fisher_x_train, fisher_y_train], validation_split = validation_split, epochs=epochs, batch_size=batch_size, patience=patience, mode='samples', \
+                                train_data_generator=fisher_data, regenerate_every=regenerate_every)
+            for trainer in self.trainer:
+                trainer.reset_split()
 
             # Generate posterior samples
             if plot==True:
                 print('Sampling approximate posterior...')
-                self.posterior_samples = self.emcee_sample(log_likelihood = lambda x: self.log_posterior_stacked(x, self.data)[0],
-                                                           x0=[self.posterior_samples[-i,:] for i in range(self.nwalkers)], \
-                                                           main_chain=self.posterior_chain_length)
+                self.update_posterior()
                 print('Done.')
 
                 # Plot the posterior
-                self.triangle_plot([self.posterior_samples], \
+                self.triangle_plot([self.posterior_samples], weights=[self.posterior_weights], \
                                     savefig=True, \
                                     filename='{}fisher_train_post.pdf'.format(self.results_dir))
 
@@ -607,7 +1451,11 @@ class Delfi():
         # Set samples to the posterior samples by default
         if samples is None:
             samples = [self.posterior_samples]
-        mc_samples = [MCSamples(samples=s, weights = None, names = self.names, labels = self.labels, ranges = self.ranges) for s in samples]
+            if weights is None:
+                weights = [self.posterior_weights]
+        if weights is None:
+            weights = [None for s in samples]
+        mc_samples = [MCSamples(samples=s, weights = w, names = self.names, labels = self.labels, ranges = self.ranges) for s, w in zip(samples, weights)]
 
         # Triangle plot
         with mpl.rc_context():
@@ -0,0 +1,321 @@
+import numpy as np
+from scipy.special import logsumexp, expit
+
+# NumPy versions of the tensorflow activation functions used by the NDEs (looked up by name)
+activations = {'tanh': np.tanh,
+               'sigmoid': expit,
+               'relu': lambda x: np.maximum(x, 0),
+               'relu6': lambda x: np.clip(x, 0, 6),
+               'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+               'selu': lambda x: 1.0507009873554805*np.where(x > 0, x, 1.6732632423543772*np.expm1(np.minimum(x, 0))),
+               'softplus': lambda x: np.logaddexp(0, x),
+               'softsign': lambda x: x/(1 + np.abs(x)),
+               'leaky_relu': lambda x: np.where(x > 0, x, 0.2*x),
+               'identity': lambda x: x}
+
+def broadcast_rows(x, y):
+    """
+    Broadcast x and y to the same number of rows (as the tensorflow graphs do, e.g. for many parameters and one data vector).
+    """
+
+    n = max(x.shape[0], y.shape[0])
+    return np.broadcast_to(x, (n, x.shape[1])), np.broadcast_to(y, (n, y.shape[1]))
+
+def activation_name(act_fun):
+    """
+    Name of a (tensorflow) activation function, checked against the supported NumPy activations.
+    """
+
+    name = getattr(act_fun, '__name__', None)
+    if name not in activations:
+        raise ValueError('no NumPy equivalent for activation function {}'.format(act_fun))
+    return name
+
+class GaussianMadeEvaluator:
+    """
+    NumPy evaluator for a trained ConditionalGaussianMade (see ConditionalGaussianMade.export).
+    The autoregressive masks are pre-multiplied into the weights, the parameters and data inputs share a
+    single first-layer matmul, and the mean and log-precision heads share a single output matmul.
+    """
+
+    def __init__(self, W_in, Ws, bs, W_out, b_out, act_fun, dtype=np.float64, output_order=None):
+        """
+        Constructor.
+        :param W_in: masked first-layer weights for the stacked inputs [parameters, data]
+        :param Ws: list of masked weights for the remaining hidden layers
+        :param bs: list of biases for all hidden layers
+        :param W_out: masked output weights for [means, log precisions]
+        :param b_out: output biases for [means, log precisions]
+        :param act_fun: name of the activation function
+        :param dtype: floating point type for the forward pass
+        :param output_order: degrees of the outputs (default sequential); outputs are sampled in this order
+        """
+
+        self.dtype = dtype
+        self.act_fun = act_fun
+        self.f = activations[act_fun]
+        self.W_in = np.ascontiguousarray(W_in, dtype=dtype)
+        self.Ws = [np.ascontiguousarray(W, dtype=dtype) for W in Ws]
+        self.bs = [np.ascontiguousarray(b, dtype=dtype) for b in bs]
+        self.W_out = np.ascontiguousarray(W_out, dtype=dtype)
+        self.b_out = np.ascontiguousarray(b_out, dtype=dtype)
+        self.n_data = self.W_out.shape[1]//2
+        self.n_parameters = self.W_in.shape[0] - self.n_data
+        self.output_order = np.arange(1, self.n_data + 1) if output_order is None else np.asarray(output_order)
+
+    def __getstate__(self):
+        # Activation functions may be lambdas, so pickle them by name
+        state = self.__dict__.copy()
+        del state['f']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.f = activations[self.act_fun]
+
+    def forward(self, x, y):
+        """
+        Means and log precisions of the conditionals.
+        """
+
+        h = self.f(np.dot(np.concatenate([x, y], axis=1), self.W_in) + self.bs[0])
+        for W, b in zip(self.Ws, self.bs[1:]):
+            h = self.f(np.dot(h, W) + b)
+        out = np.dot(h, self.W_out) + self.b_out
+        return out[:,:self.n_data], out[:,self.n_data:]
+
+    def transform(self, x, y):
+        """
+        Random numbers driving the made, and the log determinant of the transform.
+        """
+
+        m, logp = self.forward(x, y)
+        return np.exp(0.5*logp)*(y - m), 0.5*np.sum(logp, axis=1, keepdims=True)
+
+    def eval(self, xy, log=True):
+        """
+        Evaluate log probabilities for given input-output pairs.
+        :param xy: a pair (x, y) where x rows are inputs and y rows are outputs
+        :param log: whether to return probabilities in the log domain
+        :return: log probabilities: log p(y|x)
+        """
+
+        x, y = broadcast_rows(*[np.atleast_2d(np.asarray(z, dtype=self.dtype)) for z in xy])
+        u, logdet = self.transform(x, y)
+        lprob = -0.5*self.n_data*np.log(2*np.pi) - 0.5*np.sum(u**2, axis=1, keepdims=True) + logdet
+
+        return lprob if log else np.exp(lprob)
+
+    def inverse_transform(self, x, u):
+        """
+        Invert the made: the outputs y driven by random numbers u, generated one output at a time in order.
+        """
+
+        y = np.zeros(u.shape, dtype=self.dtype)
+        for i in np.argsort(self.output_order):
+            m, logp = self.forward(x, y)
+            y[:,i] = m[:,i] + np.exp(-0.5*logp[:,i])*u[:,i]
+        return y
+
+    def sample(self, theta, n=1, u=None):
+        """
+        Draw data from p(y|theta) by ancestral sampling.
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param n: number of samples per parameter vector
+        :param u: optional standard normal random numbers driving the made, shape (n_theta*n, n_data)
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
+
+        x = np.repeat(np.atleast_2d(np.asarray(theta, dtype=self.dtype)), n, axis=0)
+        u = np.random.normal(0, 1, (len(x), self.n_data)) if u is None else u
+        return self.inverse_transform(x, u)
+
+class MaskedAutoregressiveFlowEvaluator:
+    """
+    NumPy evaluator for a trained ConditionalMaskedAutoregressiveFlow: a stack of GaussianMadeEvaluators.
+    """
+
+    def __init__(self, mades):
+
+        self.mades = mades
+        self.dtype = mades[0].dtype
+        self.n_parameters = mades[0].n_parameters
+        self.n_data = mades[0].n_data
+
+    def eval(self, xy, log=True):
+        """
+        Evaluate log probabilities for given input-output pairs.
+        :param xy: a pair (x, y) where x rows are inputs and y rows are outputs
+        :param log: whether to return probabilities in the log domain
+        :return: log probabilities: log p(y|x)
+        """
+
+        x, u = broadcast_rows(*[np.atleast_2d(np.asarray(z, dtype=self.dtype)) for z in xy])
+        logdet_dudy = 0.
+        for made in self.mades:
+            u, logdet = made.transform(x, u)
+            logdet_dudy = logdet_dudy + logdet
+        lprob = -0.5*self.n_data*np.log(2*np.pi) - 0.5*np.sum(u**2, axis=1, keepdims=True) + logdet_dudy
+
+        return lprob if log else np.exp(lprob)
+
+    def sample(self, theta, n=1, u=None):
+        """
+        Draw data from p(y|theta), inverting the mades in reverse order.
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param n: number of samples per parameter vector
+        :param u: optional standard normal random numbers driving the flow, shape (n_theta*n, n_data)
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
+
+        x = np.repeat(np.atleast_2d(np.asarray(theta, dtype=self.dtype)), n, axis=0)
+        y = np.random.normal(0, 1, (len(x), self.n_data)) if u is None else u
+        for made in self.mades[::-1]:
+            y = made.inverse_transform(x, y)
+        return y
+
+class MixtureDensityNetworkEvaluator:
+    """
+    NumPy evaluator for a trained MixtureDensityNetwork.
+    """
+
+    def __init__(self, weights, biases, activations, n_data, n_components, dtype=np.float64):
+        """
+        Constructor.
+        :param weights: list of layer weights
+        :param biases: list of layer biases
+        :param activations: names of the activation functions of all but the output layer
+        :param n_data: dimension of the data
+        :param n_components: number of mixture components
+        :param dtype: floating point type for the forward pass
+        """
+
+        self.dtype = dtype
+        self.weights = [np.ascontiguousarray(W, dtype=dtype) for W in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=dtype) for b in biases]
+        self.activations = activations
+        self.n_data = n_data
+        self.M = n_components
+        self.n_parameters = self.weights[0].shape[0]
+
+        # Gather indices that reproduce tf.contrib.distributions.fill_triangular (lower) on each
+        # component's n_data*(n_data+1)/2 outputs
+        m = n_data*(n_data + 1)//2
+        self.tril = np.tril(np.concatenate([np.arange(m)[n_data:], np.arange(m)[::-1]]).reshape(n_data, n_data))
+        self.tril_mask = np.tril(np.ones((n_data, n_data), dtype=dtype))
+
+    def mixture(self, x):
+        """
+        Mixture parameters: means, Cholesky factors Sigma of the precisions (with the logs of their diagonals) and log weights.
+        """
+
+        n = self.n_data
+
+        # Forward pass
+        h = x
+        for i, (W, b) in enumerate(zip(self.weights, self.biases)):
+            h = np.dot(h, W) + b
+            if i < len(self.weights) - 1:
+                h = activations[self.activations[i]](h)
+
+        mu = h[:,:self.M*n].reshape(-1, self.M, n)
+        sigma = h[:,self.M*n:-self.M].reshape(-1, self.M, n*(n + 1)//2)
+        log_alpha = h[:,-self.M:] - logsumexp(h[:,-self.M:], axis=1, keepdims=True)
+        Sigma = sigma[...,self.tril]*self.tril_mask
+        log_diag = np.diagonal(Sigma, axis1=-2, axis2=-1).copy()
+        diag = np.arange(n)
+        Sigma[...,diag,diag] = np.exp(log_diag)
+
+        return mu, Sigma, log_diag, log_alpha
+
+    def eval(self, xy, log=True):
+        """
+        Evaluate log probabilities for given input-output pairs.
+        :param xy: a pair (x, y) where x rows are inputs and y rows are outputs
+        :param log: whether to return probabilities in the log domain
+        :return: log probabilities: log p(y|x)
+        """
+
+        x, y = [np.atleast_2d(np.asarray(z, dtype=self.dtype)) for z in xy]
+        n = self.n_data
+        mu, Sigma, log_diag, log_alpha = self.mixture(x)
+
+        # Log likelihood
+        r = np.matmul(Sigma, (y[:,np.newaxis,:] - mu)[...,np.newaxis])[...,0]
+        lprob = logsumexp(-0.5*np.sum(r**2, axis=2) + log_alpha + np.sum(log_diag, axis=2) - 0.5*n*np.log(2*np.pi), axis=1, keepdims=True)
+
+        return lprob if log else np.exp(lprob)
+
+    def sample(self, theta, n=1):
+        """
+        Draw data from p(y|theta): pick a component for each sample, then y = mu + Sigma^-1 z with z standard normal.
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param n: number of samples per parameter vector
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
+
+        x = np.atleast_2d(np.asarray(theta, dtype=self.dtype))
+        mu, Sigma, _, log_alpha = self.mixture(x)
+        return sample_mixture(mu, Sigma, np.exp(log_alpha), n)
+
+def sample_mixture(mu, Sigma, alpha, n):
+    """
+    Draw n samples for each row of a Gaussian mixture with means mu, Cholesky factors Sigma of the
+    precisions (lower triangular, shape (rows, components, n_data, n_data)) and weights alpha.
+    """
+
+    rows = np.repeat(np.arange(len(alpha)), n)
+    u = np.random.uniform(0, 1, len(rows))
+    components = np.minimum(np.sum(np.cumsum(alpha[rows], axis=1) < u[:,np.newaxis], axis=1), alpha.shape[1] - 1)
+    z = np.random.normal(0, 1, (len(rows), mu.shape[-1]))
+    return mu[rows, components] + np.linalg.solve(Sigma[rows, components], z[...,np.newaxis])[...,0]
+
+def sample_stacked(ndes, stacking_weights, x, n, *args):
+    """
+    Draw n samples for each row of x from a stack of NDEs, choosing the NDE for each sample with probability
+    given by the stacking weights (args, e.g. a tensorflow session, are passed on to the NDEs' sample methods).
+    """
+
+    rows = np.repeat(np.arange(len(x)), n)
+    choice = np.random.choice(len(ndes), size=len(rows), p=np.asarray(stacking_weights)/np.sum(stacking_weights))
+    samples = np.zeros((len(rows), ndes[0].n_data))
+    for i, nde in enumerate(ndes):
+        if np.any(choice == i):
+            samples[choice == i] = nde.sample(x[rows[choice == i]], *args)
+    return samples
+
+class StackedLikelihood:
+    """
+    Stacked NDE likelihood and posterior, as Delfi.log_likelihood_stacked/log_posterior_stacked but
+    on exported NumPy evaluators: picklable, so it can be evaluated in worker processes without tensorflow.
+    """
+
+    def __init__(self, ndes, stacking_weights, p_mean, p_std, x_mean, x_std, prior):
+
+        self.ndes = ndes
+        self.stacking_weights = np.array(stacking_weights)
+        self.p_mean = p_mean
+        self.p_std = p_std
+        self.x_mean = x_mean
+        self.x_std = x_std
+        self.prior = prior
+
+    def log_likelihood(self, theta, data):
+
+        x = np.atleast_2d((theta - self.p_mean)/self.p_std)
+        y = np.atleast_2d((data - self.x_mean)/self.x_std)
+        lnL = logsumexp(np.concatenate([nde.eval((x, y)) for nde in self.ndes], axis=1), b=self.stacking_weights, axis=1, keepdims=True)
+        lnL[np.isnan(lnL)[:,0],:] = -1e300
+        return lnL
+
+    def log_posterior(self, theta, data):
+
+        return self.log_likelihood(theta, data) + self.prior.logpdf(np.atleast_2d(theta))
+
+    def sample(self, theta, n=1):
+        # Emulated simulations: n draws of (unnormalized) data from the stacked likelihood for each row of theta
+        return sample_stacked(self.ndes, self.stacking_weights, np.atleast_2d((theta - self.p_mean)/self.p_std), n)*self.x_std + self.x_mean
+
+    def log_geometric_mean_proposal(self, theta, data):
+
+        return 0.5 * (self.log_likelihood(theta, data) + 2 * self.prior.logpdf(np.atleast_2d(theta)))
@@ -1,6 +1,7 @@
 import numpy as np
 import numpy.random as rng
 import tensorflow as tf
+import pydelfi.inference as inference
 dtype = tf.float32
 
 class ConditionalGaussianMade:
@@ -8,7 +9,7 @@ class ConditionalGaussianMade:
     Implements a Made, where each conditional probability is modelled by a single gaussian component.
     """
 
-    def __init__(self, n_parameters, n_data, n_hiddens, act_fun, output_order='sequential', mode='sequential', input_parameters=None, input_data=None, logpdf=None):
+    def __init__(self, n_parameters, n_data, n_hiddens, act_fun, output_order='sequential', mode='sequential', input_parameters=None, input_data=None, logpdf=None, inference_graph=True):
         """
         Constructor.
         :param n_inputs: number of (conditional) inputs
@@ -19,6 +20,7 @@ class ConditionalGaussianMade:
         :param mode: strategy for assigning degrees to hidden nodes: can be 'random' or 'sequential'
         :param input: tensorflow placeholder to serve as input; if None, a new placeholder is created
         :param output: tensorflow placeholder to serve as output; if None, a new placeholder is created
+        :param inference_graph: whether to build the standalone inference-mode graph (a flow chains the mades' inference_transform instead)
         """
 
         # save input arguments
@@ -34,6 +36,7 @@ class ConditionalGaussianMade:
         Wx, Ws, bs, Wm, bm, Wp, bp = self.create_weights_conditional(None)
         self.parms = [Wx] + Ws + bs + [Wm, bm, Wp, bp]
         self.output_order = degrees[0]
+        self.degrees = degrees
 
         # activation function
         f = self.act_fun
@@ -65,6 +68,58 @@ class ConditionalGaussianMade:
         self.trn_loss = -tf.reduce_mean(self.L,name='trn_loss')
         self.reg_loss = tf.losses.mean_squared_error(self.L, self.logpdf)
 
+        # inference mode: the masked weights only change during training, so they are cached in
+        # non-trainable variables (refreshed by refresh_inference_weights after training), with the
+        # [parameters, data] input weights and the mean/log-precision heads concatenated. The cache is
+        # derived from the trainable weights, so it lives in the local collection and is not checkpointed
+        masked = [tf.concat([Wx, Ms[0] * Ws[0]], axis=0)] + [M * W for M, W in zip(Ms[1:], Ws[1:])] + \
+                 [tf.concat([Mmp * Wm, Mmp * Wp], axis=1), tf.concat([bm, bp], axis=1)]
+        self.bs = bs
+        self.cached_parms = [tf.Variable(tf.zeros(w.shape, dtype=dtype), trainable=False, name='cached_parms'+str(i),
+                                         collections=[tf.GraphKeys.LOCAL_VARIABLES]) for i, w in enumerate(masked)]
+        self.cache_parms = tf.group(*[tf.assign(c, w) for c, w in zip(self.cached_parms, masked)])
+        self.inference_weights_current = False
+        if inference_graph:
+            self.build_inference_graph()
+
+    def build_inference_graph(self):
+        """
+        Build the standalone inference-mode outputs of the made (means, log precisions, random numbers and log likelihoods).
+        """
+
+        self.m_inference, self.logp_inference, self.u_inference = self.inference_transform(self.parameters, self.data)
+        self.L_inference = tf.multiply(-0.5,self.n_data * np.log(2 * np.pi) + \
+                     tf.reduce_sum(self.u_inference ** 2 - self.logp_inference, axis=1,keepdims=True),name='L_inference')
+
+    def inference_transform(self, parameters, data):
+        """
+        Inference-mode forward pass on the cached masked weights: one matmul for the stacked [parameters, data]
+        inputs and one for the stacked mean/log-precision heads.
+        :param parameters: parameters tensor
+        :param data: data tensor (parameters and data are broadcast against each other along the first axis)
+        :return: means, log precisions and random numbers driving the made
+        """
+
+        f = self.act_fun
+        W_in, Ws, W_out, b_out = self.cached_parms[0], self.cached_parms[1:-2], self.cached_parms[-2], self.cached_parms[-1]
+        parameters, data = parameters + tf.zeros_like(data[:,:1]), data + tf.zeros_like(parameters[:,:1])
+
+        h = f(tf.matmul(tf.concat([parameters, data], axis=1), W_in) + self.bs[0])
+        for W, b in zip(Ws, self.bs[1:]):
+            h = f(tf.matmul(h, W) + b)
+        m, logp = tf.split(tf.matmul(h, W_out) + b_out, 2, axis=1)
+
+        return m, logp, tf.exp(0.5 * logp) * (data - m)
+
+    def refresh_inference_weights(self, sess):
+        """
+        Copy the current masked weights into the inference-mode cache (call after training).
+        :param sess: tensorflow session where the graph is run
+        """
+
+        sess.run(self.cache_parms)
+        self.inference_weights_current = True
+
     def create_degrees(self, input_order):
         """
         Generates a degree for each hidden and input unit. A unit with degree d can only receive input from units with
@@ -173,20 +228,77 @@ class ConditionalGaussianMade:
 
             return Wx, Ws, bs, Wm, bm, Wp, bp, Wa, ba
 
-    def eval(self, xy, sess, log=True):
+    def eval(self, xy, sess, log=True, inference_mode=False):
         """
         Evaluate log probabilities for given input-output pairs.
         :param xy: a pair (x, y) where x rows are inputs and y rows are outputs
         :param sess: tensorflow session where the graph is run
         :param log: whether to return probabilities in the log domain
+        :param inference_mode: whether to use the inference-mode graph (if its weights are current)
         :return: log probabilities: log p(y|x)
         """
         
         x, y = xy
-        lprob = sess.run(self.L,feed_dict={self.parameters:x,self.data:y})
+        L = self.L_inference if inference_mode and self.inference_weights_current else self.L
+        lprob = sess.run(L,feed_dict={self.parameters:x,self.data:y})
 
         return lprob if log else np.exp(lprob)
 
+    def export(self, sess, dtype=np.float64):
+        """
+        Export the trained made to a NumPy evaluator, with the masks pre-multiplied into the weights.
+        :param sess: tensorflow session holding the trained weights
+        :param dtype: floating point type for the evaluator
+        :return: pydelfi.inference.GaussianMadeEvaluator, which evaluates without tensorflow
+        """
+
+        n_layers = len(self.n_hiddens)
+        parms = sess.run(self.parms)
+        Wx, Ws, bs, (Wm, bm, Wp, bp) = parms[0], parms[1:n_layers+1], parms[n_layers+1:2*n_layers+1], parms[2*n_layers+1:]
+        Ms = [d0[:, np.newaxis] <= d1 for d0, d1 in zip(self.degrees[:-1], self.degrees[1:])]
+        Mmp = self.degrees[-1][:, np.newaxis] < self.degrees[0]
+
+        return inference.GaussianMadeEvaluator(np.concatenate([Wx, Ms[0] * Ws[0]]), [M * W for M, W in zip(Ms[1:], Ws[1:])], bs,
+                                               np.concatenate([Mmp * Wm, Mmp * Wp], axis=1), np.concatenate([bm, bp], axis=1),
+                                               inference.activation_name(self.act_fun), dtype, self.output_order)
+
+    def inverse_transform(self, x, u, sess, inference_mode=False):
+        """
+        Invert the made: the data driven by random numbers u, generated one output at a time (n_data passes).
+        :param x: parameters, one row per sample
+        :param u: random numbers driving the made, one row per sample
+        :param sess: tensorflow session where the graph is run
+        :param inference_mode: whether to use the inference-mode graph (if its weights are current)
+        :return: data, one row per sample
+        """
+
+        inference_mode = inference_mode and self.inference_weights_current
+        if inference_mode and not hasattr(self, 'm_inference'):
+            self.build_inference_graph()
+        m_logp = [self.m_inference, self.logp_inference] if inference_mode else [self.m, self.logp]
+        y = np.zeros(u.shape)
+        for i in np.argsort(self.output_order):
+            m, logp = sess.run(m_logp,feed_dict={self.parameters:x,self.data:y})
+            y[:,i] = m[:,i] + np.exp(-0.5 * logp[:,i]) * u[:,i]
+
+        return y
+
+    def sample(self, theta, sess, n=1, u=None, inference_mode=False):
+        """
+        Draw data from p(y|theta) by ancestral sampling.
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param sess: tensorflow session where the graph is run
+        :param n: number of samples per parameter vector
+        :param u: optional standard normal random numbers driving the made, shape (n_theta*n, n_data)
+        :param inference_mode: whether to use the inference-mode graph (if its weights are current)
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
+
+        x = np.repeat(np.atleast_2d(theta), n, axis=0)
+        u = rng.randn(len(x), self.n_data) if u is None else u
+
+        return self.inverse_transform(x, u, sess, inference_mode)
+
 
 class ConditionalMaskedAutoregressiveFlow:
     """
@@ -233,7 +345,7 @@ class ConditionalMaskedAutoregressiveFlow:
             # create a new made
             with tf.variable_scope('nde_' + str(index) + '_made_' + str(i + 1)):
                 made = ConditionalGaussianMade(n_parameters, n_data, n_hiddens, act_fun,
-                                                 output_order, mode, self.parameters, self.u)
+                                                 output_order, mode, self.parameters, self.u, inference_graph=False)
             self.mades.append(made)
             self.parms += made.parms
             output_order = output_order if output_order is 'random' else made.output_order[::-1]
@@ -251,20 +363,71 @@ class ConditionalMaskedAutoregressiveFlow:
         self.trn_loss = -tf.reduce_mean(self.L,name='trn_loss')
         self.reg_loss = tf.losses.mean_squared_error(self.L, self.logpdf)
 
-    def eval(self, xy, sess, log=True):
+        # inference mode: chain the mades' forward passes on their cached masked weights
+        self.u_inference = self.data
+        self.logdet_dudy_inference = 0.0
+        for made in self.mades:
+            _, logp, self.u_inference = made.inference_transform(self.parameters, self.u_inference)
+            self.logdet_dudy_inference += 0.5 * tf.reduce_sum(logp, axis=1,keepdims=True)
+        self.L_inference = tf.add(-0.5 * n_data * np.log(2 * np.pi) - 0.5 * tf.reduce_sum(self.u_inference ** 2, axis=1,keepdims=True), self.logdet_dudy_inference,name='L_inference')
+        self.cache_parms = tf.group(*[made.cache_parms for made in self.mades])
+        self.inference_weights_current = False
+
+    def refresh_inference_weights(self, sess):
+        """
+        Copy the current masked weights of all mades into their inference-mode caches (call after training).
+        :param sess: tensorflow session where the graph is run
+        """
+
+        sess.run(self.cache_parms)
+        self.inference_weights_current = True
+        for made in self.mades:
+            made.inference_weights_current = True
+
+    def eval(self, xy, sess, log=True, inference_mode=False):
         """
         Evaluate log probabilities for given input-output pairs.
         :param xy: a pair (x, y) where x rows are inputs and y rows are outputs
         :param sess: tensorflow session where the graph is run
         :param log: whether to return probabilities in the log domain
+        :param inference_mode: whether to use the inference-mode graph (if its weights are current)
         :return: log probabilities: log p(y|x)
         """
         
         x, y = xy
-        lprob = sess.run(self.L,feed_dict={self.parameters:x,self.data:y})
+        L = self.L_inference if inference_mode and self.inference_weights_current else self.L
+        lprob = sess.run(L,feed_dict={self.parameters:x,self.data:y})
 
         return lprob if log else np.exp(lprob)
 
+    def export(self, sess, dtype=np.float64):
+        """
+        Export the trained flow to a NumPy evaluator.
+        :param sess: tensorflow session holding the trained weights
+        :param dtype: floating point type for the evaluator
+        :return: pydelfi.inference.MaskedAutoregressiveFlowEvaluator, which evaluates without tensorflow
+        """
+
+        return inference.MaskedAutoregressiveFlowEvaluator([made.export(sess, dtype) for made in self.mades])
+
+    def sample(self, theta, sess, n=1, u=None, inference_mode=False):
+        """
+        Draw data from p(y|theta), inverting the mades in reverse order (n_mades*n_data passes).
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param sess: tensorflow session where the graph is run
+        :param n: number of samples per parameter vector
+        :param u: optional standard normal random numbers driving the flow, shape (n_theta*n, n_data)
+        :param inference_mode: whether to use the inference-mode graph (if its weights are current)
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
+
+        x = np.repeat(np.atleast_2d(theta), n, axis=0)
+        y = rng.randn(len(x), self.n_data) if u is None else u
+        for made in self.mades[::-1]:
+            y = made.inverse_transform(x, y, sess, inference_mode and self.inference_weights_current)
+
+        return y
+
 class MixtureDensityNetwork:
     """
     Implements a Mixture Density Network for modeling p(y|x)
@@ -318,18 +481,27 @@ class MixtureDensityNetwork:
         self.mu, self.sigma, self.alpha = tf.split(self.layers[-1], [self.M * self.n_data, self.M * self.n_data * (self.n_data + 1) // 2, self.M], 1)
         self.mu = tf.reshape(self.mu, (-1, self.M, self.n_data))
         self.sigma = tf.reshape(self.sigma, (-1, self.M, self.n_data * (self.n_data + 1) // 2))
-        self.alpha = tf.nn.softmax(self.alpha)
+        self.log_alpha = tf.nn.log_softmax(self.alpha)
+        self.alpha = tf.exp(self.log_alpha)
         self.Sigma = tf.contrib.distributions.fill_triangular(self.sigma)
-        self.Sigma = self.Sigma - tf.linalg.diag(tf.linalg.diag_part(self.Sigma)) + tf.linalg.diag(tf.exp(tf.linalg.diag_part(self.Sigma)))
-        self.det = tf.reduce_prod(tf.linalg.diag_part(self.Sigma), axis=-1)
+        
+        # The network outputs the log of the diagonal of Sigma (the Cholesky factor of the precision),
+        # so the log determinant is just their sum
+        self.logdet = tf.reduce_sum(tf.linalg.diag_part(self.Sigma), axis=-1)
+        self.Sigma = tf.linalg.set_diag(self.Sigma, tf.exp(tf.linalg.diag_part(self.Sigma)))
+        self.det = tf.exp(self.logdet)
 
         self.mu = tf.identity(self.mu, name = "mu")
         self.Sigma = tf.identity(self.Sigma, name = "Sigma")
         self.alpha = tf.identity(self.alpha, name = "alpha")
+        self.log_alpha = tf.identity(self.log_alpha, name = "log_alpha")
         self.det = tf.identity(self.det, name = "det")
+        self.logdet = tf.identity(self.logdet, name = "logdet")
         
-        # Log likelihoods
-        self.L = tf.log(tf.reduce_sum(tf.exp(-0.5*tf.reduce_sum(tf.square(tf.einsum("ijlk,ijk->ijl", self.Sigma, tf.subtract(tf.expand_dims(self.data, 1), self.mu))), 2) + tf.log(self.alpha) + tf.log(self.det) - self.n_data*np.log(2. * np.pi) / 2.), 1, keepdims=True) + 1e-37, name = "L")
+        # Log likelihoods, accumulated in the log domain. The Sigma (y - mu) products are dense batched matmuls:
+        # triangular mat-vecs measured no faster (see benchmarks/nde_inference.py)
+        r = tf.squeeze(tf.matmul(self.Sigma, tf.expand_dims(tf.subtract(tf.expand_dims(self.data, 1), self.mu), -1)), -1)
+        self.L = tf.reduce_logsumexp(-0.5*tf.reduce_sum(tf.square(r), 2) + self.log_alpha + self.logdet - self.n_data*np.log(2. * np.pi) / 2., 1, keepdims=True, name = "L")
 
         # Objective loss function
         self.trn_loss = -tf.reduce_mean(self.L, name = "trn_loss")
@@ -349,5 +521,28 @@ class MixtureDensityNetwork:
 
         return lprob if log else np.exp(lprob)
 
+    def export(self, sess, dtype=np.float64):
+        """
+        Export the trained network to a NumPy evaluator.
+        :param sess: tensorflow session holding the trained weights
+        :param dtype: floating point type for the evaluator
+        :return: pydelfi.inference.MixtureDensityNetworkEvaluator, which evaluates without tensorflow
+        """
+
+        weights, biases = sess.run([self.weights, self.biases])
+
+        return inference.MixtureDensityNetworkEvaluator(weights, biases, [inference.activation_name(f) for f in self.activations[:len(self.n_hidden)-1]],
+                                                        self.n_data, self.M, dtype)
+
+    def sample(self, theta, sess, n=1):
+        """
+        Draw data from p(y|theta): pick a component for each sample, then y = mu + Sigma^-1 z with z standard normal.
+        :param theta: parameters, shape (n_parameters,) or (n_theta, n_parameters)
+        :param sess: tensorflow session where the graph is run
+        :param n: number of samples per parameter vector
+        :return: samples, shape (n_theta*n, n_data), with the n samples for each parameter vector in consecutive rows
+        """
 
+        mu, Sigma, alpha = sess.run([self.mu, self.Sigma, self.alpha],feed_dict={self.parameters:np.atleast_2d(theta)})
 
+        return inference.sample_mixture(mu, Sigma, alpha, n)
@@ -23,7 +23,15 @@ class TruncatedGaussian():
         inrange = np.prod(x > self.lower)*np.prod(x < self.upper)
         return inrange*np.prod(self.upper-self.lower)
 
-    def draw(self):
+    def draw(self, n=None):
+
+        # Batch of n draws (rejection sampling a batch at a time)
+        if n is not None:
+            x = np.zeros((0, len(self.mean)))
+            while len(x) < n:
+                y = self.mean + np.dot(np.random.normal(0, 1, (n, len(self.mean))), self.L.T)
+                x = np.concatenate([x, y[np.all(y > self.lower, axis=-1)*np.all(y < self.upper, axis=-1)]])
+            return x[:n]
 
         P = 0
         while P == 0:
@@ -37,7 +45,14 @@ class TruncatedGaussian():
 
     def logpdf(self, x):
         
-        return np.array([self.loguniform(xx) - 0.5*self.logdet - 0.5*np.dot((xx - self.mean), np.dot(self.Cinv,(xx - self.mean)) ) for xx in x])
+        x = np.atleast_2d(x)
+        inrange = np.all(x > self.lower, axis=-1)*np.all(x < self.upper, axis=-1)
+        loguniform = inrange*np.log(np.prod(self.upper-self.lower)) - (1 - inrange)*1e300
+        return loguniform - 0.5*self.logdet - 0.5*np.einsum('ij,jk,ik->i', x - self.mean, self.Cinv, x - self.mean)
+
+    def logpdf_gradient(self, x):
+
+        return -np.dot(np.atleast_2d(x) - self.mean, self.Cinv)
 
 
 class Uniform():
@@ -49,14 +64,20 @@ class Uniform():
 
     def logpdf(self, x):
 
-        inrange = lambda y: np.prod(y > self.lower)*np.prod(y < self.upper)
-        return np.array([inrange(xx)*np.log(np.prod(self.upper-self.lower)) - (1 - inrange(xx))*1e300 for xx in x])
+        inrange = np.all(np.atleast_2d(x) > self.lower, axis=-1)*np.all(np.atleast_2d(x) < self.upper, axis=-1)
+        return inrange*np.log(np.prod(self.upper-self.lower)) - (1 - inrange)*1e300
     
     def pdf(self, x):
         
         inrange = lambda y: np.prod(y > self.lower)*np.prod(y < self.upper)
         return np.array([inrange(xx)*np.prod(self.upper-self.lower) for xx in x])
 
-    def draw(self):
+    def logpdf_gradient(self, x):
+
+        return np.zeros(np.atleast_2d(x).shape)
+
+    def draw(self, n=None):
 
+        if n is not None:
+            return np.random.uniform(self.lower, self.upper, (n,) + np.shape(self.lower))
         return np.random.uniform(self.lower, self.upper)
@@ -14,6 +14,20 @@ def isnotebook():
     except NameError:
         return False
 
+# Batch-aware compressor for Delfi: declares `batched = True` so that Delfi passes
+# the whole stack of simulations to a single call of compress(d)
+class BatchCompressor():
+
+    batched = True
+
+    def __init__(self, compress):
+
+        self.compress = compress
+
+    def __call__(self, d, compressor_args = None):
+
+        return self.compress(d)
+
 class Gaussian():
 
     def __init__(self, ndata, theta_fiducial, mu = None, Cinv = None, dmudt = None, dCdt = None, F = None, prior_mean = None, prior_covariance = None, rank=0, n_procs=1, comm=None, red_op=None):
@@ -173,7 +187,22 @@ class Gaussian():
         self.simulations = np.concatenate([self.simulations, sims_dash])
         self.parameters = np.concatenate([self.parameters, theta])
 
-    # Fisher score maximum likelihood estimator
+    # Score (derivative of the log-likelihood at the fiducial parameters)
+    # for a data vector d, or a batch of data vectors stacked along the first axis
+    def score(self, d):
+        
+        # Add terms from mean derivatives
+        r = np.asarray(d) - self.mu
+        dLdt = np.dot(r, np.dot(self.Cinv, self.dmudt.T))
+                
+        # Add terms from covariance derivatives
+        if self.dCdt is not None:
+            CinvdCdt = np.matmul(self.Cinv, self.dCdt)
+            dLdt = dLdt - 0.5*np.trace(CinvdCdt, axis1=1, axis2=2) + 0.5*np.einsum('...i,aij,...j->...a', r, np.matmul(CinvdCdt, self.Cinv), r)
+
+        return dLdt
+
+    # Fisher score maximum likelihood estimator (d can be a single data vector or a batch)
     def scoreMLE(self, d):
         
         if self.F is None:
@@ -181,19 +210,10 @@ class Gaussian():
             return None
         
         # Compute the score
-        dLdt = np.zeros(self.npar)
-    
-        # Add terms from mean derivatives
-        for a in range(self.npar):
-            dLdt[a] += np.dot(self.dmudt[a,:], np.dot(self.Cinv, (d - self.mu)))
-                
-        # Add terms from covariance derivatives
-        if self.dCdt is not None:
-            for a in range(self.npar):
-                dLdt[a] += -0.5*np.trace(np.dot(self.Cinv, self.dCdt[a,:,:])) + 0.5*np.dot((d - self.mu), np.dot( np.dot(self.Cinv, np.dot(self.dCdt[a,:,:], self.Cinv)), (d - self.mu)))
+        dLdt = self.score(d)
 
         # Cast to MLE
-        t = self.theta_fiducial + np.dot(self.Finv, dLdt)
+        t = self.theta_fiducial + np.dot(dLdt, self.Finv.T)
         
         # Correct for gaussian prior if one is provided
         if self.prior_mean is not None:
@@ -231,34 +251,20 @@ class Gaussian():
         # indices for interesting parameters
         interesting = np.delete(np.arange(self.npar), nuisances)
         n_interesting = len(interesting)
-        n_nuisance = len(nuisances)
         
         # Compute projection vectors
-        P = np.zeros((n_interesting, n_nuisance))
         Fnn_inv = np.linalg.inv(np.delete(np.delete(self.F, interesting, axis = 0), interesting, axis = 1))
         Finv_tt = np.delete(np.delete(self.Finv, nuisances, axis=0), nuisances, axis=1)
-        for i in range(n_interesting):
-            P[i,:] = np.dot(Fnn_inv, self.F[i,nuisances])
+        P = np.dot(self.F[np.ix_(np.arange(n_interesting), nuisances)], Fnn_inv.T)
 
         # Compute the score
-        dLdt = np.zeros(self.npar)
-    
-        # Add terms from mean derivatives
-        for a in range(self.npar):
-            dLdt[a] += np.dot(self.dmudt[a,:], np.dot(self.Cinv, (d - self.mu)))
-        
-        # Add terms from covariance derivatives
-        if self.dCdt is not None:
-            for a in range(self.npar):
-                dLdt[a] += -0.5*np.trace(np.dot(self.Cinv, self.dCdt[a,:,:])) + 0.5*np.dot((d - self.mu), np.dot( np.dot(self.Cinv, np.dot(self.dCdt[a,:,:], self.Cinv)), (d - self.mu)))
+        dLdt = self.score(d)
 
         # Do the projection
-        dLdt_projected = np.zeros(n_interesting)
-        for a in range(n_interesting):
-            dLdt_projected[a] = dLdt[a] - np.dot(P[a], dLdt[nuisances])
+        dLdt_projected = dLdt[...,:n_interesting] - np.dot(dLdt[...,nuisances], P.T)
 
         # Cast it back into an MLE
-        t = np.dot(Finv_tt, dLdt_projected) + self.theta_fiducial[interesting]
+        t = np.dot(dLdt_projected, Finv_tt.T) + self.theta_fiducial[interesting]
 
         # Correct for the prior if one is provided
         if self.prior_mean is not None:
@@ -267,6 +273,14 @@ class Gaussian():
 
         return t
 
+    # Batch-aware Delfi compressor: score MLE, or nuisance projected score MLE if nuisances are given
+    def batch_compressor(self, nuisances = None):
+
+        if nuisances is None:
+            return BatchCompressor(self.scoreMLE)
+        else:
+            return BatchCompressor(lambda d: self.projected_scoreMLE(d, nuisances))
+
 
 class Wishart():
 
@@ -289,17 +303,23 @@ class Wishart():
             self.F = self.fisher()
         self.Finv = np.linalg.inv(self.F)
 
-    # Fisher score maximum likelihood estimator
+    # Score (derivative of the log-likelihood at the fiducial parameters) for a
+    # data tensor d of shape (ndata, n, n), or a batch of them stacked along the first axis
+    def score(self, d):
+    
+        CinvdCdt = np.matmul(self.Cinv, self.dCdt)
+        dLdt = -0.5*np.einsum('l,alii->a', self.nu, CinvdCdt) + 0.5*np.einsum('l,alij,...lji->...a', self.nu, np.matmul(CinvdCdt, self.Cinv), d)
+
+        return dLdt
+
+    # Fisher score maximum likelihood estimator (d can be a single data tensor or a batch)
     def scoreMLE(self, d):
     
         # Compute the score
-        dLdt = np.zeros(self.npar)
-        for a in range(self.npar):
-            for l in range(self.ndata):
-                dLdt[a] += self.nu[l]*(-0.5*np.trace(np.dot(self.Cinv[l,:,:], self.dCdt[a,l,:,:])) + 0.5*np.trace(np.dot( np.dot(self.Cinv[l,:,:], np.dot(self.dCdt[a,l,:,:], self.Cinv[l,:,:])), d[l,:,:]) ) )
+        dLdt = self.score(d)
 
         # Make it an MLE
-        t = np.dot(self.Finv, dLdt) + self.theta_fiducial
+        t = np.dot(dLdt, self.Finv.T) + self.theta_fiducial
 
         # Correct for prior if there is one
         if self.prior_covariance is not None:
@@ -330,28 +350,20 @@ class Wishart():
         # indices for interesting parameters
         interesting = np.delete(np.arange(self.npar), nuisances)
         n_interesting = len(interesting)
-        n_nuisance = len(nuisances)
         
         # Compute projection vectors
-        P = np.zeros((n_interesting, n_nuisance))
         Fnn_inv = np.linalg.inv(np.delete(np.delete(self.F, interesting, axis = 0), interesting, axis = 1))
         Finv_tt = np.delete(np.delete(self.Finv, nuisances, axis=0), nuisances, axis=1)
-        for i in range(n_interesting):
-            P[i,:] = np.dot(Fnn_inv, self.F[i,nuisances])
+        P = np.dot(self.F[np.ix_(np.arange(n_interesting), nuisances)], Fnn_inv.T)
 
         # Compute the score
-        dLdt = np.zeros(self.npar)
-        for a in range(self.npar):
-            for l in range(self.ndata):
-                dLdt[a] += self.nu[l]*(-0.5*np.trace(np.dot(self.Cinv[l,:,:], self.dCdt[a,l,:,:])) + 0.5*np.trace(np.dot( np.dot(self.Cinv[l,:,:], np.dot(self.dCdt[a,l,:,:], self.Cinv[l,:,:])), d[l,:,:]) ) )
+        dLdt = self.score(d)
 
         # Do the projection
-        dLdt_projected = np.zeros(n_interesting)
-        for a in range(n_interesting):
-            dLdt_projected[a] = dLdt[a] - np.dot(P[a], dLdt[nuisances])
+        dLdt_projected = dLdt[...,:n_interesting] - np.dot(dLdt[...,nuisances], P.T)
 
         # Cast it back into an MLE
-        t = np.dot(Finv_tt, dLdt_projected) + self.theta_fiducial[interesting]
+        t = np.dot(dLdt_projected, Finv_tt.T) + self.theta_fiducial[interesting]
 
         # Correct for the prior if one is provided
         if self.prior_mean is not None:
@@ -360,3 +372,10 @@ class Wishart():
 
         return t
 
+    # Batch-aware Delfi compressor: score MLE, or nuisance projected score MLE if nuisances are given
+    def batch_compressor(self, nuisances = None):
+
+        if nuisances is None:
+            return BatchCompressor(self.scoreMLE)
+        else:
+            return BatchCompressor(lambda d: self.projected_scoreMLE(d, nuisances))
@@ -2,63 +2,274 @@ import tensorflow as tf
 import numpy as np
 import numpy.random as rng
 import os
+import time
 from tqdm.auto import tqdm
 
+class ReduceLROnPlateau():
+    """
+    Learning-rate schedule that multiplies the learning rate by factor whenever the validation loss
+    has not improved (by more than min_delta) for patience epochs. Converged once the learning rate
+    is down to min_learning_rate and the loss plateaus again. Each training run (e.g. each population
+    of a sequential run) starts again from the initial learning rate, unless keep_learning_rate is set,
+    in which case it continues from the decayed one.
+    """
+    def __init__(self, learning_rate=1e-3, factor=0.5, patience=5, min_learning_rate=1e-6, min_delta=0., keep_learning_rate=False):
+
+        self.initial_learning_rate = learning_rate
+        self.keep_learning_rate = keep_learning_rate
+        self.learning_rate = learning_rate
+        self.factor = factor
+        self.patience = patience
+        self.min_learning_rate = min_learning_rate
+        self.min_delta = min_delta
+        self.best_loss = np.inf
+        self.count = 0
+        self.converged = False
+
+    def __call__(self, epoch):
+        return self.learning_rate
+
+    def start(self, epoch=0):
+        # New training run (possibly on a new training set): forget the losses
+        if not self.keep_learning_rate:
+            self.learning_rate = self.initial_learning_rate
+        self.best_loss = np.inf
+        self.count = 0
+        self.converged = False
+
+    def update(self, epoch, val_loss):
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.count = 0
+        else:
+            self.count += 1
+            if self.count >= self.patience:
+                self.count = 0
+                self.converged = self.learning_rate <= self.min_learning_rate
+                self.learning_rate = max(self.learning_rate*self.factor, self.min_learning_rate)
+
+class CosineSchedule():
+    """
+    Cosine annealing from learning_rate to min_learning_rate over period epochs, with warm restarts;
+    each restart multiplies the period by period_mult.
+    """
+    def __init__(self, learning_rate=1e-3, period=50, min_learning_rate=1e-6, period_mult=1.):
+
+        if period_mult < 1:
+            raise ValueError('period_mult must be >= 1.')
+        self.learning_rate = learning_rate
+        self.period = period
+        self.min_learning_rate = min_learning_rate
+        self.period_mult = period_mult
+        self.converged = False
+
+    def __call__(self, epoch):
+        t, T = epoch, self.period
+        while t >= T:
+            t -= T
+            T *= self.period_mult
+        return self.min_learning_rate + 0.5*(self.learning_rate - self.min_learning_rate)*(1 + np.cos(np.pi*t/T))
+
+    def start(self, epoch=0):
+        pass
+
+    def update(self, epoch, val_loss):
+        pass
+
+class OneCycleSchedule():
+    """
+    One-cycle schedule: cosine warm-up from max_learning_rate/div_factor to max_learning_rate over the
+    first pct_start of the cycle, then cosine annealing down to max_learning_rate/(div_factor*final_div_factor).
+    Converged (and held at the final learning rate) once the cycle of epochs epochs is complete. Every
+    training run goes through a full cycle of its own, counted from the epoch it starts at.
+    """
+    def __init__(self, max_learning_rate=1e-2, epochs=100, pct_start=0.3, div_factor=25., final_div_factor=1e4):
+
+        self.max_learning_rate = max_learning_rate
+        self.epochs = epochs
+        self.pct_start = pct_start
+        self.initial_learning_rate = max_learning_rate/div_factor
+        self.final_learning_rate = self.initial_learning_rate/final_div_factor
+        self.start_epoch = 0
+        self.converged = False
+
+    def __call__(self, epoch):
+        t = min(max(epoch - self.start_epoch, 0)/self.epochs, 1.)
+        if t < self.pct_start:
+            lr0, lr1, x = self.initial_learning_rate, self.max_learning_rate, t/self.pct_start
+        else:
+            lr0, lr1, x = self.max_learning_rate, self.final_learning_rate, (t - self.pct_start)/(1 - self.pct_start)
+        return lr1 + 0.5*(lr0 - lr1)*(1 + np.cos(np.pi*x))
+
+    def start(self, epoch=0):
+        self.start_epoch = epoch
+        self.converged = False
+
+    def update(self, epoch, val_loss):
+        self.converged = epoch - self.start_epoch >= self.epochs
+
 class ConditionalTrainer():
     
-    def __init__(self, model, optimizer=tf.train.AdamOptimizer, optimizer_arguments={}):
+    def __init__(self, model, optimizer=tf.train.AdamOptimizer, optimizer_arguments={}, schedule=None):
         """
             Constructor that defines the training operation.
             :param model: made/maf instance to be trained.
             :param optimizer: tensorflow optimizer class to be used during training.
             :param optimizer_arguments: dictionary of arguments for optimizer intialization.
+            :param schedule: optional learning-rate schedule (ReduceLROnPlateau, CosineSchedule or
+                OneCycleSchedule). It overrides any learning rate in optimizer_arguments, and its state
+                (like the count of epochs trained) persists across calls to train.
             """
         
         self.model = model
+        self.schedule = schedule
+        if schedule is not None:
+            self.learning_rate = tf.placeholder_with_default(np.float32(schedule(0.)), shape=[], name='learning_rate')
+            optimizer_arguments = dict(optimizer_arguments, learning_rate=self.learning_rate)
         self.train_optimizer = optimizer(**optimizer_arguments).minimize(self.model.trn_loss)
         self.train_reg_optimizer = optimizer(**optimizer_arguments).minimize(self.model.reg_loss)
 
+        # Squared norms of the loss gradients (used to estimate the gradient noise scale), built on
+        # the first training run with adaptive_batch_size
+        self.trn_grad_norm = None
+        self.reg_grad_norm = None
+
+        # Per-epoch batch size, throughput and gradient noise scale, over all calls to train
+        self.epoch_stats = []
+
+        # Persistent train/validation split: index arrays into the training data, extended as rows are appended
+        self.reset_split()
+
+        # Epochs trained over all calls to train, and the epoch of the best validation loss within each call
+        self.epochs_trained = 0
+        self.convergence_epochs = []
+
+    def reset_split(self):
+        # Forget the train/validation split (e.g. before training on a different data set)
+        self.trn_idx = np.zeros(0, dtype=int)
+        self.val_idx = np.zeros(0, dtype=int)
+        self.n_split = 0
+
+    def update_split(self, N, validation_split):
+        # Assign rows n_split..N-1 (appended since the last call) to the training or validation
+        # set, keeping the validation set at validation_split of the rows overall
+        if N < self.n_split:
+            self.reset_split()
+        new_idx = self.n_split + rng.permutation(N - self.n_split)
+        n_val_target = max(int(validation_split*N), 1 if validation_split > 0 else 0)
+        n_val = min(max(n_val_target - len(self.val_idx), 0), len(new_idx))
+        self.val_idx = np.concatenate([self.val_idx, new_idx[:n_val]])
+        self.trn_idx = np.concatenate([self.trn_idx, new_idx[n_val:]])
+        self.n_split = N
+
+    def squared_gradient_norm(self, loss):
+        # Gradient with respect to this model's own weights only (MADE/MAF parms, MDN weights and biases)
+        parms = self.model.parms if hasattr(self.model, 'parms') else self.model.weights + self.model.biases
+        grads = [g for g in tf.gradients(loss, parms) if g is not None]
+        return tf.add_n([tf.reduce_sum(tf.square(g)) for g in grads])
+
     """
     Training class for the conditional MADEs/MAFs classes using a tensorflow optimizer.
     """           
     def train(self, sess, train_data, validation_split = 0.1, epochs=1000, batch_size=100,
-              patience=20, saver_name='tmp_model', progress_bar=True, mode='samples'):
+              patience=20, saver_name='tmp_model', progress_bar=True, mode='samples',
+              warm_start=False, sample_weights=None, max_time=None, adaptive_batch_size=False, max_batch_size=None,
+              train_data_generator=None, regenerate_every=1):
         """
         Training function to be called with desired parameters within a tensorflow session.
         :param sess: tensorflow session where the graph is run.
         :param train_data: a tuple/list of (X,Y) with training data where Y is conditioned on X.
-        :param validation_split: percentage of training data randomly selected to be used for validation
+        :param validation_split: percentage of training data randomly selected to be used for validation. The split
+            persists across calls: rows appended to the training data since the last call are split between training
+            and validation, while earlier rows keep their assignment (see reset_split).
         :param epochs: maximum number of epochs for training.
         :param batch_size: batch size of each batch within an epoch.
         :param early_stopping: number of epochs for early stopping criteria.
         :param check_every_N: check every N iterations if model has improved and saves if so.
         :param saver_name: string of name (with or without folder) where model is saved. If none is given,
             a temporal model is used to save and restore best model, and removed afterwards.
+        :param warm_start: if True, the current weights are taken as the best model so far, so training
+            continues from them and can only return a model at least as good on the validation set.
+        :param sample_weights: optional per-sample weights (one per row of the training data); minibatches
+            are then drawn with probability proportional to the weights.
+        :param max_time: optional wall-clock budget in seconds; training stops after the first epoch past it.
+        :param adaptive_batch_size: if True, batch_size is only the initial batch size: after each epoch it grows
+            (at most doubling) towards the gradient noise scale B = tr(Sigma)/|G|^2, estimated from the gradient
+            norms over a minibatch and a four times larger batch [McCandlish et al. 2018, arXiv:1812.06162].
+        :param max_batch_size: upper limit for the adaptive batch size (default: a quarter of the training set).
+        :param train_data_generator: optional function returning fresh training data in the format of train_data
+            (for data that can be generated on the fly). train_data is then the fixed validation set (validation_split
+            is ignored), and the training rows are replaced by a new generated set every regenerate_every epochs.
+        :param regenerate_every: number of epochs between new sets of training data from train_data_generator.
+        Batch size, steps/sec, samples/sec and the noise scale estimate for each epoch are appended to self.epoch_stats.
+        Training also stops once the learning-rate schedule (if any) has converged. The number of epochs
+        it took to reach the best validation loss is appended to self.convergence_epochs.
         """
         
-        # Training data
-        if mode == 'samples':
-            train_data_X, train_data_Y  = train_data
-        elif mode == 'regression':
-            train_data_X, train_data_Y, train_data_PDF  = train_data
-        train_idx = np.arange(train_data_X.shape[0])
-        
-        # validation data using p_val percent of the data
-        rng.shuffle(train_idx)
-        N = train_data_X.shape[0]
-        val_data_X = train_data_X[train_idx[-int(validation_split*N):]]
-        train_data_X = train_data_X[train_idx[:-int(validation_split*N)]]
-        val_data_Y = train_data_Y[train_idx[-int(validation_split*N):]]
-        train_data_Y = train_data_Y[train_idx[:-int(validation_split*N)]]
-        if mode == 'regression':
-            val_data_PDF = train_data_PDF[train_idx[-int(validation_split*N):]]
-            train_data_PDF = train_data_PDF[train_idx[:-int(validation_split*N)]]
-        train_idx = np.arange(train_data_X.shape[0])
+        # Training data, as (X, Y, PDF) arrays
+        def unpack(data):
+            if mode == 'samples':
+                return data[0], data[1], None
+            elif mode == 'regression':
+                return data[0], data[1], data[2]
+
+        # Training and validation rows, as indices into the (uncopied) training data. With a training data
+        # generator, train_data is held out as the validation set and the training rows are generated
+        if train_data_generator is None:
+            trn_data = val_data = unpack(train_data)
+            self.update_split(trn_data[0].shape[0], validation_split)
+            train_idx = self.trn_idx
+            val_idx = self.val_idx
+        else:
+            if sample_weights is not None:
+                raise ValueError('sample_weights cannot be used with a training data generator')
+            val_data, trn_data = unpack(train_data), unpack(train_data_generator())
+            val_idx, train_idx = np.arange(val_data[0].shape[0]), np.arange(trn_data[0].shape[0])
+        if sample_weights is not None:
+            train_p = np.asarray(sample_weights, dtype=np.float64)[train_idx]
+            train_p = train_p/np.sum(train_p)
+
+        # Feed dictionary for the rows idx of the data
+        def feed(data, idx):
+            X, Y, PDF = data
+            feed_dict = {self.model.parameters:X[idx], self.model.data:Y[idx]}
+            if mode == 'regression':
+                feed_dict[self.model.logpdf] = PDF[idx]
+            return feed_dict
+
+        # Loss over the rows idx of the data, evaluated in chunks to bound memory (both losses are means over rows)
+        def loss(data, idx, chunk=10000):
+            loss_op = self.model.trn_loss if mode == 'samples' else self.model.reg_loss
+            return sum(sess.run(loss_op,feed_dict=feed(data, idx[i:i+chunk]))*len(idx[i:i+chunk])
+                       for i in range(0, len(idx), chunk))/len(idx)
+
+        # Squared gradient norm over the rows idx
+        if adaptive_batch_size and self.trn_grad_norm is None:
+            self.trn_grad_norm = self.squared_gradient_norm(self.model.trn_loss)
+            self.reg_grad_norm = self.squared_gradient_norm(self.model.reg_loss)
+        def grad_norm(idx):
+            return sess.run(self.trn_grad_norm if mode == 'samples' else self.reg_grad_norm,feed_dict=feed(trn_data, idx))
+
+        # Adaptive batch size: exponential moving averages of the |G|^2 and tr(Sigma) estimates
+        if max_batch_size is None:
+            max_batch_size = max(batch_size, len(train_idx)//4)
+        G2_ema = S_ema = None
+        noise_scale = np.nan
 
         # Early stopping variables
         bst_loss = np.infty
+        bst_epoch = 0
         early_stopping_count = 0
         saver = tf.train.Saver()
+        if warm_start:
+            bst_loss = loss(val_data, val_idx)
+            if saver_name is not None:
+                saver.save(sess,"./"+saver_name)
+        start_time = time.time()
+        if hasattr(self.model, 'inference_weights_current'):
+            self.model.inference_weights_current = False
+        if self.schedule is not None:
+            self.schedule.start(self.epochs_trained)
         
         # Validation and training losses
         validation_losses = []
@@ -69,40 +280,63 @@ class ConditionalTrainer():
             pbar = tqdm(total = epochs, desc = "Training")
             pbar.set_postfix(ordered_dict={"train loss":0, "val loss":0}, refresh=True)
         for epoch in range(epochs):
-            # Shuffel training indices
-            rng.shuffle(train_idx)
-            for batch in range(len(train_idx)//batch_size):
+            # Fresh training rows from the generator every regenerate_every epochs
+            if train_data_generator is not None and epoch > 0 and epoch % regenerate_every == 0:
+                trn_data = unpack(train_data_generator())
+                train_idx = np.arange(trn_data[0].shape[0])
+
+            # Shuffel training indices (or resample them according to the sample weights)
+            if sample_weights is None:
+                epoch_idx = rng.permutation(train_idx)
+            else:
+                epoch_idx = rng.choice(train_idx, size=len(train_idx), p=train_p)
+            n_batches = len(train_idx)//batch_size
+            epoch_start_time = time.time()
+            for batch in range(n_batches):
                 # Last batch will have maximum number of elements possible
-                batch_idx = train_idx[batch*batch_size:np.min([(batch+1)*batch_size,len(train_idx)])]
+                batch_idx = epoch_idx[batch*batch_size:np.min([(batch+1)*batch_size,len(epoch_idx)])]
 
+                feed_dict = feed(trn_data, batch_idx)
+                if self.schedule is not None:
+                    feed_dict[self.learning_rate] = self.schedule(self.epochs_trained + batch/n_batches)
                 if mode == 'samples':
-                    sess.run(self.train_optimizer,feed_dict={self.model.parameters:train_data_X[batch_idx],
-                                                      self.model.data:train_data_Y[batch_idx]})
+                    sess.run(self.train_optimizer,feed_dict=feed_dict)
                 elif mode == 'regression':
-                    sess.run(self.train_reg_optimizer,feed_dict={self.model.parameters:train_data_X[batch_idx],
-                             self.model.data:train_data_Y[batch_idx],
-                             self.model.logpdf:train_data_PDF[batch_idx]})
+                    sess.run(self.train_reg_optimizer,feed_dict=feed_dict)
+            epoch_time = max(time.time() - epoch_start_time, 1e-12)
+            self.epochs_trained += 1
+
+            # Gradient noise scale, from the gradient norms at two batch sizes b_small < b_big
+            if adaptive_batch_size:
+                b_small, b_big = batch_size, min(4*batch_size, len(train_idx))
+                if b_big > b_small:
+                    idx = rng.permutation(train_idx)[:b_big]
+                    g2_small, g2_big = grad_norm(idx[:b_small]), grad_norm(idx)
+                    G2 = (b_big*g2_big - b_small*g2_small)/(b_big - b_small)
+                    S = (g2_small - g2_big)/(1./b_small - 1./b_big)
+                    G2_ema = G2 if G2_ema is None else 0.9*G2_ema + 0.1*G2
+                    S_ema = S if S_ema is None else 0.9*S_ema + 0.1*S
+                    if G2_ema > 0 and S_ema > 0:
+                        noise_scale = S_ema/G2_ema
+            self.epoch_stats.append({'epoch': self.epochs_trained, 'batch_size': batch_size,
+                                     'steps_per_sec': n_batches/epoch_time, 'samples_per_sec': n_batches*batch_size/epoch_time,
+                                     'noise_scale': noise_scale})
+            if adaptive_batch_size and np.isfinite(noise_scale):
+                batch_size = int(min(max_batch_size, max(batch_size, min(2*batch_size, noise_scale))))
+
             # Early stopping check
-            if mode == 'samples':
-                val_loss = sess.run(self.model.trn_loss,feed_dict={self.model.parameters:val_data_X,
-                                                                    self.model.data:val_data_Y})
-                train_loss = sess.run(self.model.trn_loss,feed_dict={self.model.parameters:train_data_X,
-                                                                         self.model.data:train_data_Y})
-            elif mode == 'regression':
-                val_loss = sess.run(self.model.reg_loss,feed_dict={self.model.parameters:val_data_X,
-                                                                   self.model.data:val_data_Y,
-                                                                   self.model.logpdf:val_data_PDF})
-                train_loss = sess.run(self.model.reg_loss,feed_dict={self.model.parameters:train_data_X,
-                                                                     self.model.data:train_data_Y,
-                                                                     self.model.logpdf:train_data_PDF})
+            val_loss = loss(val_data, val_idx)
+            train_loss = loss(trn_data, train_idx)
             if progress_bar:
                 pbar.update()
-                pbar.set_postfix(ordered_dict={"train loss":train_loss, "val loss":val_loss}, refresh=True)
+                pbar.set_postfix(ordered_dict={"train loss":train_loss, "val loss":val_loss,
+                                               "samples/s":int(self.epoch_stats[-1]['samples_per_sec'])}, refresh=True)
             validation_losses.append(val_loss)
             training_losses.append(train_loss)
                 
             if val_loss < bst_loss:
                 bst_loss = val_loss
+                bst_epoch = epoch + 1
                 if saver_name is not None:
                     saver.save(sess,"./"+saver_name)
                 early_stopping_count = 0
@@ -111,9 +345,18 @@ class ConditionalTrainer():
             if early_stopping_count >= patience:
                 #pbar.set_postfix(str="Early stopping: terminated", refresh=True)
                 break
+            if max_time is not None and time.time() - start_time > max_time:
+                break
+            if self.schedule is not None:
+                self.schedule.update(self.epochs_trained, val_loss)
+                if self.schedule.converged:
+                    break
+        self.convergence_epochs.append(bst_epoch)
 
-        # Restore best model
+        # Restore best model, and refresh the inference-mode weights cache
         if saver_name is not None:
             saver.restore(sess, saver_name)
+        if hasattr(self.model, 'refresh_inference_weights'):
+            self.model.refresh_inference_weights(sess)
 
         return np.array(validation_losses), np.array(training_losses)
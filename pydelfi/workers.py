@@ -0,0 +1,251 @@
+import io
+import multiprocessing
+import pickle
+import time
+import types
+import numpy as np
+
+# Run one simulator call (sub_batch simulations at theta) and compress the outputs
+def simulate_and_compress(simulator, compressor, theta, seed, simulator_args, compressor_args, sub_batch = 1):
+
+    sims = simulator(theta, seed, simulator_args, sub_batch)
+
+    # Make sure the sims are the right shape
+    if sub_batch == 1 and len(sims) != 1:
+        sims = np.array([sims])
+
+    # Compressors declaring batch support (batched = True) compress the
+    # whole (sub_batch, ...) array of simulations in a single call
+    if getattr(compressor, 'batched', False):
+        return np.atleast_2d(compressor(np.asarray(sims), compressor_args))
+    else:
+        return np.array([compressor(sims[k], compressor_args) for k in range(sub_batch)])
+
+# Pickler that only records whether the pickle refers to functions or classes defined in __main__
+class MainReferenceDetector(pickle.Pickler):
+
+    def __init__(self):
+
+        super().__init__(io.BytesIO())
+        self.main_references = False
+
+    def reducer_override(self, obj):
+
+        if isinstance(obj, (type, types.FunctionType)) and getattr(obj, '__module__', None) == '__main__':
+            self.main_references = True
+        return NotImplemented
+
+# Multiprocessing context for worker processes that are sent the objects obj: forkserver where available,
+# otherwise spawn. Forking a process that holds a tensorflow session and its thread pools can deadlock, so
+# fork is only used for objects a fresh interpreter cannot unpickle: objects that cannot be pickled, and
+# functions or classes defined in __main__ (e.g. a simulator defined in a notebook), which pickle by reference
+def process_context(obj = None):
+
+    try:
+        detector = MainReferenceDetector()
+        detector.dump(obj)
+        fork = detector.main_references
+    except (pickle.PicklingError, AttributeError, TypeError):
+        fork = True
+    if fork and 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Loop run by a SimulationWorker process: receive (theta, seed), send back the compressed sims
+def simulation_worker_loop(conn, simulator, compressor, simulator_args, compressor_args, sub_batch):
+
+    conn.send('ready')
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        theta, seed = job
+        try:
+            conn.send(('accepted', simulate_and_compress(simulator, compressor, theta, seed, simulator_args, compressor_args, sub_batch)))
+        except Exception as e:
+            conn.send(('exception', repr(e)))
+
+class SimulationWorker():
+
+    # Runs simulate_and_compress in a separate process, so that a hung simulator
+    # can be killed after a timeout and the worker replaced by a fresh one.
+    # Workers are started without forking where possible (see process_context).
+    def __init__(self, simulator, compressor, simulator_args, compressor_args, sub_batch = 1):
+
+        self.args = (simulator, compressor, simulator_args, compressor_args, sub_batch)
+        self.context = process_context(self.args)
+        if self.context.get_start_method() == 'fork':
+            print('Simulator/compressor defined in __main__ or not picklable: forking the simulation worker instead')
+        self.start()
+
+    # Start a worker and wait until it is ready, so that its start-up (module imports in a fresh
+    # interpreter) does not count against the first simulation's timeout
+    def start(self):
+
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target = simulation_worker_loop, args = (child_conn,) + self.args, daemon = True)
+        self.process.start()
+        child_conn.close()
+        try:
+            self.conn.recv()
+        except EOFError:
+            raise RuntimeError('Simulation worker process failed to start')
+
+    def restart(self):
+
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        self.start()
+
+    # Returns (status, result) with status one of 'accepted', 'exception' or 'timeout'
+    def run(self, theta, seed, timeout):
+
+        self.conn.send((theta, seed))
+        if not self.conn.poll(timeout):
+            self.restart()
+            return 'timeout', None
+        try:
+            return self.conn.recv()
+        except EOFError:
+            # The worker died (e.g. the simulator crashed the interpreter)
+            self.restart()
+            return 'exception', None
+
+    def close(self):
+
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout = 1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+# Log posterior ('posterior') or geometric-mean proposal ('proposal') density of an exported
+# StackedLikelihood for the rows of theta, and the time the evaluation took
+def stacked_log_density(likelihood, density, theta, data):
+
+    start_time = time.time()
+    lnL = likelihood.log_likelihood(theta, data)[:,0]
+    if density == 'proposal':
+        lnL = 0.5*lnL
+    return lnL + likelihood.prior.logpdf(theta), time.time() - start_time
+
+# Loop run by a ParallelLogDensity worker process, with the same messages as Delfi.serve_log_density:
+# ('update', likelihood, density, data) loads the current NDEs, ('eval', theta) evaluates a batch. Every
+# message is answered with (status, result), status 'accepted' or 'exception' (with the repr of the exception)
+def log_density_worker_loop(conn):
+
+    while True:
+        try:
+            message = conn.recv()
+            if message is None:
+                break
+            if message[0] == 'update':
+                likelihood, density, data = message[1:]
+                conn.send(('accepted', None))
+            else:
+                conn.send(('accepted', stacked_log_density(likelihood, density, message[1], data)))
+        except EOFError:
+            break
+        except Exception as e:
+            conn.send(('exception', repr(e)))
+
+class ParallelLogDensity():
+
+    # Vectorized log density for emcee (vectorize = True): each batch of walkers is split over the
+    # MPI ranks (rank 0 included; the others must be in Delfi.serve_log_density) or over a set of
+    # local worker processes, each holding its own exported NumPy copy of the NDEs. The workers are
+    # started on the first update (without forking where possible, see process_context) and loaded
+    # with the current NDEs by update before each sampling run. Keeps track of the time the workers
+    # spend evaluating against the wall time, for the parallel efficiency of the run.
+    def __init__(self, comm = None, n_workers = None):
+
+        self.comm = comm
+        if comm is not None:
+            self.n_workers = comm.Get_size()
+        else:
+            self.n_workers = n_workers if n_workers is not None else multiprocessing.cpu_count()
+            self.context = None
+            self.conns, self.processes = [], []
+
+    # (Re)start the local workers with the given multiprocessing context
+    def start(self, context):
+
+        self.close()
+        self.context = context
+        if context.get_start_method() == 'fork':
+            print('Likelihood/prior defined in __main__ or not picklable: forking the log density workers instead')
+        for i in range(self.n_workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target = log_density_worker_loop, args = (child_conn,), daemon = True)
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    # Results of the last message sent to each local worker
+    def receive(self):
+
+        results = []
+        for conn in self.conns:
+            try:
+                status, result = conn.recv()
+            except EOFError:
+                raise RuntimeError('Log density worker process died')
+            if status == 'exception':
+                raise RuntimeError('Log density worker failed: {}'.format(result))
+            results.append(result)
+        return results
+
+    def update(self, likelihood, density, data):
+
+        self.likelihood, self.density, self.data = likelihood, density, data
+        if self.comm is not None:
+            self.comm.bcast(('update', likelihood, density, data), root = 0)
+        else:
+            context = process_context(likelihood)
+            if context is not self.context:
+                self.start(context)
+            message = pickle.dumps(('update', likelihood, density, data))
+            for conn in self.conns:
+                conn.send_bytes(message)
+            self.receive()
+        self.busy_time = 0.
+        self.wall_time = 0.
+
+    def __call__(self, theta):
+
+        start_time = time.time()
+        chunks = np.array_split(np.atleast_2d(theta), self.n_workers)
+        if self.comm is not None:
+            self.comm.bcast(('eval', theta), root = 0)
+            results = self.comm.gather(stacked_log_density(self.likelihood, self.density, chunks[0], self.data), root = 0)
+        else:
+            for conn, chunk in zip(self.conns, chunks):
+                conn.send(('eval', chunk))
+            results = self.receive()
+        self.busy_time += sum([r[1] for r in results])
+        self.wall_time += time.time() - start_time
+        return np.concatenate([r[0] for r in results])
+
+    # Fraction of the workers' wall time spent evaluating the density (1 for perfect scaling)
+    def efficiency(self):
+
+        return self.busy_time/(self.n_workers*self.wall_time) if self.wall_time > 0 else 0.
+
+    def close(self):
+
+        if self.comm is None:
+            for conn, process in zip(self.conns, self.processes):
+                try:
+                    conn.send(None)
+                except (OSError, ValueError):
+                    pass
+                process.join(timeout = 1)
+                if process.is_alive():
+                    process.terminate()
+                conn.close()
+            self.conns, self.processes = [], []
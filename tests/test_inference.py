@@ -0,0 +1,69 @@
+"""
+Tests of the exported NumPy evaluators against the tensorflow graphs they were exported from.
+"""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'placeholder'):
+    pytest.skip('pydelfi.ndes needs the tensorflow 1.x graph API', allow_module_level=True)
+
+import pydelfi.ndes as ndes
+
+N_PARAMETERS = 2
+N_DATA = 3
+
+# Run an NDE's graph in a fresh session, with freshly initialized weights
+def build(nde_class, **kwargs):
+
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    nde = nde_class(n_parameters=N_PARAMETERS, n_data=N_DATA, **kwargs)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    return nde, sess
+
+def data(n=50, scale=1.):
+
+    rng = np.random.RandomState(0)
+    return rng.normal(0, 1, (n, N_PARAMETERS)), scale*rng.normal(0, 1, (n, N_DATA))
+
+def test_made_evaluator():
+
+    made, sess = build(ndes.ConditionalGaussianMade, n_hiddens=[20, 20], act_fun=tf.tanh, output_order='random')
+    x, y = data()
+    np.testing.assert_allclose(made.export(sess).eval((x, y)), made.eval((x, y), sess), rtol=1e-4, atol=1e-4)
+
+def test_maf_evaluator():
+
+    maf, sess = build(ndes.ConditionalMaskedAutoregressiveFlow, n_hiddens=[20, 20], act_fun=tf.tanh, n_mades=3)
+    x, y = data()
+    np.testing.assert_allclose(maf.export(sess).eval((x, y)), maf.eval((x, y), sess), rtol=1e-4, atol=1e-4)
+
+def test_mdn_evaluator():
+
+    mdn, sess = build(ndes.MixtureDensityNetwork, n_components=4, n_hidden=[20, 20], activations=[tf.tanh, tf.tanh])
+    evaluator = mdn.export(sess)
+
+    # The fill_triangular gather, and the exponentiated diagonal, against tensorflow
+    x, y = data(scale=100.)
+    mu, Sigma, log_alpha, logdet = sess.run([mdn.mu, mdn.Sigma, mdn.log_alpha, mdn.logdet], feed_dict={mdn.parameters: x})
+    mu_np, Sigma_np, log_diag, log_alpha_np = evaluator.mixture(x)
+    np.testing.assert_allclose(mu_np, mu, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(Sigma_np, Sigma, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(np.sum(log_diag, axis=-1), logdet, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(log_alpha_np, log_alpha, rtol=1e-4, atol=1e-5)
+
+    # The mixture log-sum-exp, with data far enough out that summing the component densities underflows
+    lprob = evaluator.eval((x, y))
+    assert np.all(np.isfinite(lprob)) and np.min(lprob) < -800
+    np.testing.assert_allclose(lprob, mdn.eval((x, y), sess), rtol=1e-4)
+
+    # ... and against the explicit sum of the component densities, where that doesn't underflow
+    x, y = data()
+    mu, Sigma, log_diag, log_alpha = evaluator.mixture(x)
+    r = np.einsum('nkij,nkj->nki', Sigma, y[:,np.newaxis,:] - mu)
+    density = np.sum(np.exp(log_alpha + np.sum(log_diag, axis=-1) - 0.5*np.sum(r**2, axis=-1))/(2*np.pi)**(N_DATA/2), axis=1)
+    np.testing.assert_allclose(evaluator.eval((x, y))[:,0], np.log(density), rtol=1e-10)
+    np.testing.assert_allclose(evaluator.eval((x, y)), mdn.eval((x, y), sess), rtol=1e-4, atol=1e-4)
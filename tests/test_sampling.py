@@ -0,0 +1,160 @@
+"""
+Tests of ancestral sampling from the NDEs: inverting the transforms, and the moments of samples against the densities.
+"""
+
+import numpy as np
+import pytest
+
+from pydelfi.inference import GaussianMadeEvaluator, MaskedAutoregressiveFlowEvaluator, MixtureDensityNetworkEvaluator, sample_stacked
+
+N_PARAMETERS = 2
+N_DATA = 2
+N_SAMPLES = 50000
+
+# A made with random weights, masked as ConditionalGaussianMade.export does
+def random_made(rng, n_hiddens=[10, 10]):
+
+    degrees = [rng.permutation(np.arange(1, N_DATA + 1))] + [rng.randint(1, N_DATA, n) for n in n_hiddens]
+    Ms = [d0[:,np.newaxis] <= d1 for d0, d1 in zip(degrees[:-1], degrees[1:])]
+    Mmp = degrees[-1][:,np.newaxis] < degrees[0]
+    W = lambda n0, n1: rng.normal(0, np.sqrt(1./(n0 + 1)), (n0, n1))
+
+    return GaussianMadeEvaluator(np.concatenate([W(N_PARAMETERS, n_hiddens[0]), Ms[0]*W(N_DATA, n_hiddens[0])]),
+                                 [M*W(*M.shape) for M in Ms[1:]], [rng.normal(0, 0.1, (1, n)) for n in n_hiddens],
+                                 np.concatenate([Mmp*W(n_hiddens[-1], N_DATA), Mmp*W(n_hiddens[-1], N_DATA)], axis=1),
+                                 rng.normal(0, 0.5, (1, 2*N_DATA)), 'tanh', output_order=degrees[0])
+
+def random_mdn(rng, n_components=3, n_hidden=10):
+
+    N = (N_DATA + N_DATA*(N_DATA + 1)//2 + 1)*n_components
+    return MixtureDensityNetworkEvaluator([rng.normal(0, 1, (N_PARAMETERS, n_hidden)), rng.normal(0, 0.5, (n_hidden, N))],
+                                          [rng.normal(0, 0.1, n_hidden), rng.normal(0, 0.5, N)], ['tanh'], N_DATA, n_components)
+
+# Mean and covariance of the mixture from an MDN's parameters at a single theta
+def mixture_moments(mdn, theta):
+
+    mu, Sigma, _, log_alpha = mdn.mixture(np.atleast_2d(theta))
+    mu, Sigma, alpha = mu[0], Sigma[0], np.exp(log_alpha[0])
+    C = np.linalg.inv(np.matmul(np.swapaxes(Sigma, -1, -2), Sigma))
+    mean = np.dot(alpha, mu)
+    return mean, np.einsum('k,kij->ij', alpha, C + mu[:,:,np.newaxis]*mu[:,np.newaxis,:]) - np.outer(mean, mean)
+
+# Mean and covariance of the density on a grid covering the samples
+def density_moments(nde, theta, samples, n_grid=400):
+
+    axes = [np.linspace(lo - 1, hi + 1, n_grid) for lo, hi in zip(samples.min(axis=0), samples.max(axis=0))]
+    y = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, N_DATA)
+    p = nde.eval((theta, y), log=False)[:,0]*np.prod([a[1] - a[0] for a in axes])
+    mean = np.dot(p, y)
+    return np.sum(p), mean, np.dot(p*(y - mean).T, y - mean)
+
+def check_moments(samples, mean, cov):
+
+    np.testing.assert_allclose(np.mean(samples, axis=0), mean, atol=5*np.sqrt(np.max(np.diag(cov))/len(samples)))
+    np.testing.assert_allclose(np.cov(samples, rowvar=False), cov, atol=0.05*np.max(np.diag(cov)))
+
+def test_made_round_trip():
+
+    rng = np.random.RandomState(0)
+    made = random_made(rng)
+    x, u = rng.normal(0, 1, (100, N_PARAMETERS)), rng.normal(0, 1, (100, N_DATA))
+    np.testing.assert_allclose(made.transform(x, made.inverse_transform(x, u))[0], u, rtol=1e-10, atol=1e-10)
+
+def test_maf_round_trip():
+
+    rng = np.random.RandomState(1)
+    maf = MaskedAutoregressiveFlowEvaluator([random_made(rng) for i in range(3)])
+    theta, u = rng.normal(0, 1, N_PARAMETERS), rng.normal(0, 1, (100, N_DATA))
+    y = maf.sample(theta, 100, u)
+    x = np.repeat(theta[np.newaxis,:], 100, axis=0)
+    for made in maf.mades:
+        y = made.transform(x, y)[0]
+    np.testing.assert_allclose(y, u, rtol=1e-10, atol=1e-10)
+
+def test_maf_sample_moments():
+
+    rng = np.random.RandomState(2)
+    np.random.seed(2)
+    maf = MaskedAutoregressiveFlowEvaluator([random_made(rng) for i in range(3)])
+    theta = rng.normal(0, 1, N_PARAMETERS)
+    samples = maf.sample(theta, N_SAMPLES)
+    norm, mean, cov = density_moments(maf, theta, samples)
+    np.testing.assert_allclose(norm, 1, atol=1e-3)
+    check_moments(samples, mean, cov)
+
+def test_mdn_sample_moments():
+
+    rng = np.random.RandomState(3)
+    np.random.seed(3)
+    mdn = random_mdn(rng)
+    theta = rng.normal(0, 1, N_PARAMETERS)
+    samples = mdn.sample(theta, N_SAMPLES)
+    mean, cov = mixture_moments(mdn, theta)
+    check_moments(samples, mean, cov)
+
+    # The mixture moments are those of the density
+    norm, density_mean, density_cov = density_moments(mdn, theta, samples, n_grid=1000)
+    np.testing.assert_allclose(norm, 1, atol=1e-3)
+    np.testing.assert_allclose(density_mean, mean, atol=1e-3)
+    np.testing.assert_allclose(density_cov, cov, atol=1e-3)
+
+def test_sample_stacked():
+
+    rng = np.random.RandomState(4)
+    np.random.seed(4)
+    mdns = [random_mdn(rng), random_mdn(rng)]
+    weights = np.array([0.3, 0.7])
+    theta = rng.normal(0, 1, (2, N_PARAMETERS))
+    samples = sample_stacked(mdns, 10*weights, theta, N_SAMPLES)
+    for i in range(len(theta)):
+        moments = [mixture_moments(mdn, theta[i]) for mdn in mdns]
+        mean = sum(w*m for w, (m, C) in zip(weights, moments))
+        cov = sum(w*(C + np.outer(m, m)) for w, (m, C) in zip(weights, moments)) - np.outer(mean, mean)
+        check_moments(samples[i*N_SAMPLES:(i + 1)*N_SAMPLES], mean, cov)
+
+def tensorflow():
+
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'placeholder'):
+        pytest.skip('pydelfi.ndes needs the tensorflow 1.x graph API')
+    return tf
+
+# The tensorflow NDEs, run in a fresh graph with freshly initialized weights
+def build(tf, nde_class, **kwargs):
+
+    import pydelfi.ndes as ndes
+
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    nde = getattr(ndes, nde_class)(n_parameters=N_PARAMETERS, n_data=N_DATA, **kwargs)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    return nde, sess
+
+def test_tensorflow_made_round_trip():
+
+    tf = tensorflow()
+    made, sess = build(tf, 'ConditionalGaussianMade', n_hiddens=[10, 10], act_fun=tf.tanh, output_order='random')
+    rng = np.random.RandomState(5)
+    x, u = rng.normal(0, 1, (100, N_PARAMETERS)), rng.normal(0, 1, (100, N_DATA))
+    y = made.inverse_transform(x, u, sess)
+    np.testing.assert_allclose(sess.run(made.u, feed_dict={made.parameters: x, made.data: y}), u, rtol=1e-4, atol=1e-4)
+
+def test_tensorflow_maf_round_trip():
+
+    tf = tensorflow()
+    maf, sess = build(tf, 'ConditionalMaskedAutoregressiveFlow', n_hiddens=[10, 10], act_fun=tf.tanh, n_mades=3)
+    rng = np.random.RandomState(6)
+    theta, u = rng.normal(0, 1, N_PARAMETERS), rng.normal(0, 1, (100, N_DATA))
+    y = maf.sample(theta, sess, 100, u)
+    feed_dict = {maf.parameters: np.repeat(theta[np.newaxis,:], 100, axis=0), maf.data: y}
+    np.testing.assert_allclose(sess.run(maf.u, feed_dict=feed_dict), u, rtol=1e-4, atol=1e-4)
+
+def test_tensorflow_mdn_sample_moments():
+
+    tf = tensorflow()
+    mdn, sess = build(tf, 'MixtureDensityNetwork', n_components=3, n_hidden=[10, 10], activations=[tf.tanh, tf.tanh])
+    np.random.seed(7)
+    theta = np.random.normal(0, 1, N_PARAMETERS)
+    samples = mdn.sample(theta, sess, N_SAMPLES)
+    check_moments(samples, *mixture_moments(mdn.export(sess), theta))
@@ -0,0 +1,92 @@
+"""
+Tests of the simulation and log density worker processes, including simulators and priors defined in
+__main__ (as in the example notebooks), which a forkserver/spawn worker cannot unpickle.
+"""
+
+import os
+import subprocess
+import sys
+import numpy as np
+
+from pydelfi.workers import process_context
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Run code as the __main__ module of a fresh interpreter, without a file behind it (like a notebook)
+def run_as_main(code):
+
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+def test_process_context():
+
+    assert process_context(np.sum).get_start_method() != 'fork'
+    assert process_context(lambda x: x).get_start_method() == 'fork'
+
+SIMULATION_WORKER = """
+import time
+import numpy as np
+from pydelfi.workers import SimulationWorker
+
+def simulator(theta, seed, simulator_args, sub_batch):
+    if theta[0] < 0:
+        time.sleep(30)
+    return theta + 1
+
+def compressor(data, compressor_args):
+    return data
+
+worker = SimulationWorker(simulator, compressor, None, None)
+status, result = worker.run(np.array([1., 2.]), 0, 10)
+assert status == 'accepted' and np.allclose(result, [[2., 3.]]), (status, result)
+status, result = worker.run(np.array([-1., 2.]), 0, 0.5)
+assert status == 'timeout', status
+status, result = worker.run(np.array([3., 4.]), 0, 10)
+assert status == 'accepted' and np.allclose(result, [[4., 5.]]), (status, result)
+worker.close()
+print('done')
+"""
+
+def test_simulation_worker_main_simulator():
+
+    assert 'done' in run_as_main(SIMULATION_WORKER)
+
+PARALLEL_LOG_DENSITY = """
+import numpy as np
+from pydelfi.workers import ParallelLogDensity
+
+class Prior():
+    def logpdf(self, x):
+        return -0.5*np.sum(np.atleast_2d(x)**2, axis=1)
+
+class Likelihood():
+    def __init__(self):
+        self.prior = Prior()
+    def log_likelihood(self, theta, data):
+        return -0.5*np.sum((np.atleast_2d(theta) - data)**2, axis=1, keepdims=True)
+
+class FailingLikelihood(Likelihood):
+    def log_likelihood(self, theta, data):
+        raise ValueError('bad theta')
+
+theta = np.random.normal(0, 1, (7, 2))
+data = np.ones(2)
+pool = ParallelLogDensity(n_workers=2)
+pool.update(Likelihood(), 'proposal', data)
+expected = -0.25*np.sum((theta - data)**2, axis=1) - 0.5*np.sum(theta**2, axis=1)
+assert np.allclose(pool(theta), expected)
+pool.update(FailingLikelihood(), 'posterior', data)
+try:
+    pool(theta)
+    raise AssertionError('no error raised')
+except RuntimeError as e:
+    assert 'bad theta' in str(e), e
+pool.close()
+print('done')
+"""
+
+def test_parallel_log_density_main_prior():
+
+    assert 'done' in run_as_main(PARALLEL_LOG_DENSITY)